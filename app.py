@@ -2,8 +2,16 @@
 import dash
 from dash import dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
-import pandas as pd
-import io, base64
+import os
+import numpy as np
+
+from armazenamento import (EscritorOriginal, cache, contar_partes_original, copiar_original, filtrar_parte_original,
+                          guardar_dataset, novo_id, obter_dataset)
+from dataset import DatasetAnalise, montar_cubo_semanal
+from metricas import etapa
+from ingestao import (COLUNAS_CHAVE_LINHA, COLUNAS_CLIENTES, COLUNAS_FRANQUIAS, COLUNAS_FRANQUIAS_OPCIONAIS,
+                      AcumuladorClientes, AcumuladorFranquias, FiltroLinhasRepetidas, blocos_tipados, colunas_comuns,
+                      decodificar_para_arquivo, ler_arquivos_em_paralelo, ler_blocos, remover_tipados, tipar_bloco)
 
 # Importa a instância do app e os layouts das páginas
 from index import app, server
@@ -11,7 +19,6 @@ from pages import clientes, franquias
 
 # --- LAYOUT PRINCIPAL E COMPONENTES ---
 app.layout = html.Div([
-    dcc.Store(id='store-dados-originais'),
     dcc.Store(id='store-dados-clientes'),
     dcc.Store(id='store-dados-franquias'),
     
@@ -28,79 +35,191 @@ app.layout = html.Div([
 ])
 
 upload_component = html.Div([
-    html.H3("Selecione o arquivo para análise", className="text-center mb-4"),
+    html.H3("Selecione os arquivos para análise", className="text-center mb-4"),
     dcc.Upload(
         id='upload-data',
-        children=html.Div(['Arraste e solte ou ', html.A('selecione seu arquivo')]),
+        children=html.Div(['Arraste e solte ou ', html.A('selecione um ou mais arquivos')]),
+        multiple=True,
         style={'width': '100%', 'height': '120px', 'lineHeight': '120px', 'borderWidth': '2px', 'borderStyle': 'dashed',
                'borderRadius': '10px', 'textAlign': 'center', 'margin': '20px 0'}
     ),
+    dbc.Input(id='input-colunas-extras', placeholder="Colunas extras a manter na análise de franquias (opcional, separadas por vírgula)"),
+    dbc.Switch(id='switch-modo-incremental', label="Acrescentar ao conjunto já carregado (apenas o novo período)", value=False, className="mt-2"),
+    # Progresso e cancelamento do processamento em segundo plano
+    html.Div(id='painel-progresso-upload', style={'display': 'none'}, className="mt-3", children=[
+        dbc.Progress(id='progresso-upload', value=0, striped=True, animated=True, className="mb-2"),
+        dbc.Button("Cancelar", id='btn-cancelar-upload', color="secondary", size="sm"),
+    ]),
     html.Div(id='output-upload-status')
 ])
 
 # --- FUNÇÃO DE PROCESSAMENTO GERAL E ADAPTATIVA ---
-def processar_arquivo_geral(contents, filename):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+def processar_arquivo_geral(contents, filename, colunas_extras=None, dataset_base=None, progresso=None):
+    """Processa o upload em blocos; devolve (dataset_id, dataset_clientes, dataset_franquias, mensagem).
+
+    Com `dataset_base`, o arquivo é acrescentado ao conjunto desse upload (modo incremental): linhas
+    já existentes são descartadas e os agregados por cliente são atualizados a partir dos anteriores.
+    O resultado sempre ganha um ID novo; o conjunto anterior continua válido.
+    `contents` e `filename` podem ser listas (vários arquivos): eles são lidos em paralelo,
+    unidos pelas colunas em comum e as linhas repetidas entre arquivos são descartadas.
+    `progresso(fracao, texto)`, se informado, é chamado a cada etapa da leitura.
+    """
+    dataset_id = novo_id()
+    # O dcc.Upload com `multiple=True` entrega listas; um único arquivo continua aceito
+    arquivos = list(zip(contents, filename)) if isinstance(contents, list) else [(contents, filename)]
+    nome_arquivos = ', '.join(f"'{nome}'" for _, nome in arquivos)
+    colunas_extras = [col.strip() for col in (colunas_extras or []) if col.strip()]
+    colunas_mantidas_franquias = list(dict.fromkeys(COLUNAS_FRANQUIAS + COLUNAS_FRANQUIAS_OPCIONAIS + colunas_extras))
+    caminho = None
     try:
-        df = pd.read_excel(io.BytesIO(decoded)) if 'xls' in filename else pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-        df_original = df.copy()
-        df.columns = [str(col).strip() for col in df.columns]
-
-        df['Data Emissao'] = pd.to_datetime(df.get('Data Emissao'), dayfirst=True, errors='coerce')
-        df['R$ Total'] = pd.to_numeric(df.get('R$ Total'), errors='coerce')
-
-        df_clientes, df_franquias = None, None
-
-        # Tenta processar a análise de Clientes (sem depender de franquia)
-        colunas_clientes = ['Data Emissao', 'R$ Total', 'Nome Fantasia', 'Vendedor']
-        if all(col in df.columns for col in colunas_clientes):
-            df_cl = df.dropna(subset=colunas_clientes).copy()
-            if not df_cl.empty:
-                faturamento_total = df_cl.groupby('Nome Fantasia')['R$ Total'].sum().reset_index().rename(columns={'R$ Total': 'Faturamento Total'})
-                ultimas_compras = df_cl.sort_values('Data Emissao').drop_duplicates('Nome Fantasia', keep='last')[['Nome Fantasia', 'Data Emissao', 'Vendedor']].rename(columns={'Data Emissao': 'Ultima Compra', 'Vendedor': 'Vendedor da Ultima Compra'})
-                df_clientes = pd.merge(faturamento_total, ultimas_compras, on='Nome Fantasia')
-                df_clientes['Dias Sem Comprar'] = (df_cl['Data Emissao'].max() - df_clientes['Ultima Compra']).dt.days
-
-        # Tenta processar a análise de Franquias (apenas se a coluna existir)
-        colunas_franquias = ['Data Emissao', 'R$ Total', 'FRANQUIA', 'Descrição Item', 'Categoria']
-        if all(col in df.columns for col in colunas_franquias):
-            df_franquias = df.dropna(subset=colunas_franquias).copy()
-
-        if df_clientes is None and df_franquias is None:
-             return None, None, None, "Erro: O arquivo não contém as colunas mínimas necessárias (ex: 'Data Emissao', 'R$ Total', 'Nome Fantasia')."
-
-        return df_original, df_clientes, df_franquias, f"Arquivo '{filename}' carregado com sucesso."
+        acumulador_clientes = AcumuladorClientes()
+        acumulador_franquias = AcumuladorFranquias(colunas_mantidas_franquias)
+        filtro_repetidas = FiltroLinhasRepetidas()
+        if dataset_base:
+            anterior_clientes = obter_dataset(dataset_base, 'clientes')
+            anterior_franquias = obter_dataset(dataset_base, 'franquias')
+            chaves_anteriores = obter_dataset(dataset_base, 'chaves')
+            if anterior_clientes is None and anterior_franquias is None:
+                return None, None, None, "Erro: O conjunto de dados anterior expirou. Carregue o histórico completo novamente."
+            if anterior_clientes is not None:
+                acumulador_clientes = AcumuladorClientes.a_partir_de(anterior_clientes.df)
+            if anterior_franquias is not None:
+                colunas_mantidas_franquias = list(anterior_franquias.df.columns)
+                acumulador_franquias = AcumuladorFranquias(colunas_mantidas_franquias, anterior_franquias.df)
+            filtro_repetidas = FiltroLinhasRepetidas(chaves_anteriores, bool(obter_dataset(dataset_base, 'sem_chave')))
+            copiar_original(dataset_base, dataset_id)
+        colunas_analise = list(dict.fromkeys(COLUNAS_CLIENTES + colunas_mantidas_franquias + COLUNAS_CHAVE_LINHA))
+
+        def acumular(bloco):
+            colunas_bloco = set(bloco.columns)
+            # Tenta processar a análise de Clientes (sem depender de franquia)
+            if all(col in colunas_bloco for col in COLUNAS_CLIENTES):
+                acumulador_clientes.adicionar(bloco)
+            # Tenta processar a análise de Franquias (apenas se a coluna existir)
+            if all(col in colunas_bloco for col in COLUNAS_FRANQUIAS):
+                acumulador_franquias.adicionar(bloco)
+
+        if len(arquivos) == 1:
+            with etapa('upload.decodificacao'):
+                caminho = decodificar_para_arquivo(*arquivos[0])
+            avisar = (lambda fracao: progresso(0.9 * fracao, "Lendo o arquivo...")) if progresso else None
+            with etapa('upload.leitura'), EscritorOriginal(dataset_id) as original:
+                for bloco in ler_blocos(caminho, arquivos[0][1], progresso=avisar):
+                    bloco_tipado = tipar_bloco(bloco, colunas_analise)
+                    novas = filtro_repetidas.linhas_novas(bloco_tipado)
+                    original.escrever(bloco[novas], bloco_tipado[novas])
+                    acumular(bloco_tipado[novas])
+        else:
+            # Vários arquivos: cada um é decodificado e lido em um processo; aqui só se juntam os resultados
+            avisar = (lambda fracao: progresso(0.9 * fracao, "Lendo os arquivos...")) if progresso else None
+            with etapa('upload.leitura_paralela'):
+                lidos = ler_arquivos_em_paralelo(arquivos, colunas_analise, dataset_id,
+                                                 contar_partes_original(dataset_id), progresso=avisar)
+            try:
+                with etapa('upload.uniao'):
+                    comuns = colunas_comuns([tipado for _, tipado in lidos], colunas_analise)
+                    for parte, tipado in lidos:
+                        # Linhas já vistas em arquivos anteriores (ou no conjunto base) são descartadas
+                        mascaras = []
+                        for bloco in blocos_tipados(tipado, comuns):
+                            novas = filtro_repetidas.linhas_novas(bloco)
+                            mascaras.append(novas)
+                            acumular(bloco[novas])
+                        filtro_repetidas.consolidar()
+                        if mascaras:  # arquivo só com o cabeçalho não tem linhas a filtrar
+                            filtrar_parte_original(parte, np.concatenate(mascaras))
+            finally:
+                remover_tipados(tipado for _, tipado in lidos)
+
+        if progresso:
+            progresso(0.9, "Montando as análises...")
+        dataset_clientes, dataset_franquias = None, None
+
+        with etapa('upload.agregacao_clientes'):
+            df_clientes = acumulador_clientes.resultado()
+        if df_clientes is not None:
+            # Monta uma única vez o dataset tipado e indexado usado pelos callbacks da página
+            with etapa('upload.indices_clientes'):
+                dataset_clientes = DatasetAnalise(df_clientes,
+                                                  colunas_categoricas=['Nome Fantasia', 'Vendedor da Ultima Compra'],
+                                                  colunas_indexadas=['Nome Fantasia', 'Vendedor da Ultima Compra'],
+                                                  colunas_data=['Ultima Compra'],
+                                                  colunas_busca=['Nome Fantasia', 'Vendedor da Ultima Compra'])
+
+        with etapa('upload.uniao_franquias'):
+            df_franquias = acumulador_franquias.resultado()
+        if df_franquias is not None:
+            with etapa('upload.indices_franquias'):
+                dataset_franquias = DatasetAnalise(df_franquias,
+                                                   colunas_categoricas=['Categoria'],
+                                                   colunas_indexadas=['FRANQUIA', 'Descrição Item'],
+                                                   colunas_data=['Data Emissao'],
+                                                   colunas_busca=['FRANQUIA', 'Descrição Item'])
+            with etapa('upload.cubo_franquias'):
+                cache.guardar(dataset_id, 'cubo_franquias', montar_cubo_semanal(dataset_franquias.df))
+
+        if dataset_clientes is None and dataset_franquias is None:
+            cache.remover_dataset(dataset_id)
+            return None, None, None, "Erro: O arquivo não contém as colunas mínimas necessárias (ex: 'Data Emissao', 'R$ Total', 'Nome Fantasia')."
+
+        cache.guardar(dataset_id, 'chaves', filtro_repetidas.resultado())
+        cache.guardar(dataset_id, 'sem_chave', filtro_repetidas.sem_chave)
+        if dataset_base:
+            mensagem = f"Arquivo(s) {nome_arquivos} acrescentado(s) ao conjunto atual."
+        else:
+            mensagem = f"Arquivo(s) {nome_arquivos} carregado(s) com sucesso."
+        if filtro_repetidas.descartadas:
+            mensagem += f" {filtro_repetidas.descartadas} linha(s) repetida(s) descartada(s)."
+        if filtro_repetidas.sem_chave and (dataset_base or len(arquivos) > 1):
+            mensagem += " Sem as colunas 'Documento' ou 'N° OS', linhas repetidas não puderam ser identificadas e foram mantidas."
+        return dataset_id, dataset_clientes, dataset_franquias, mensagem
     except Exception as e:
+        cache.remover_dataset(dataset_id)
         return None, None, None, f'Ocorreu um erro ao processar o arquivo: {e}'
+    finally:
+        if caminho:
+            os.remove(caminho)
 
 
 # --- CALLBACKS ---
 
-# Callback 1: Processa o arquivo e redireciona para a tela de seleção
+# Callback 1: Processa o arquivo (em segundo plano, com progresso) e redireciona para a tela de seleção
 @app.callback(
     [Output('output-upload-status', 'children'),
-     Output('store-dados-originais', 'data'),
      Output('store-dados-clientes', 'data'),
      Output('store-dados-franquias', 'data'),
      Output('url', 'pathname')],
     Input('upload-data', 'contents'),
-    State('upload-data', 'filename')
+    [State('upload-data', 'filename'),
+     State('input-colunas-extras', 'value'),
+     State('switch-modo-incremental', 'value'),
+     State('store-dados-clientes', 'data'),
+     State('store-dados-franquias', 'data')],
+    background=True,
+    progress=[Output('progresso-upload', 'value'), Output('progresso-upload', 'label')],
+    running=[(Output('upload-data', 'disabled'), True, False),
+             (Output('painel-progresso-upload', 'style'), {'display': 'block'}, {'display': 'none'})],
+    cancel=[Input('btn-cancelar-upload', 'n_clicks')],
 )
-def processa_e_redireciona(contents, filename):
+def processa_e_redireciona(set_progress, contents, filename, colunas_extras, modo_incremental, id_clientes_atual, id_franquias_atual):
     if contents:
-        df_original, df_clientes, df_franquias, message = processar_arquivo_geral(contents, filename)
-        
-        json_original = df_original.to_json(date_format='iso', orient='split') if df_original is not None else None
-        json_clientes = df_clientes.to_json(date_format='iso', orient='split') if df_clientes is not None else None
-        json_franquias = df_franquias.to_json(date_format='iso', orient='split') if df_franquias is not None else None
+        colunas_extras = colunas_extras.split(',') if colunas_extras else None
+        dataset_base = (id_clientes_atual or id_franquias_atual) if modo_incremental else None
+        progresso = lambda fracao, texto: set_progress((round(100 * fracao), texto))
+        with etapa('upload.total'):
+            dataset_id, dataset_clientes, dataset_franquias, message = processar_arquivo_geral(contents, filename, colunas_extras, dataset_base, progresso)
 
-        if json_clientes or json_franquias:
-            return dbc.Alert(message, color="success"), json_original, json_clientes, json_franquias, '/selecao'
+        if dataset_clientes is not None or dataset_franquias is not None:
+            # Os datasets ficam no cache do servidor; os Stores recebem apenas o ID do upload
+            with etapa('upload.armazenamento'):
+                guardar_dataset(dataset_id, {'clientes': dataset_clientes, 'franquias': dataset_franquias})
+            id_clientes = dataset_id if dataset_clientes is not None else None
+            id_franquias = dataset_id if dataset_franquias is not None else None
+            return dbc.Alert(message, color="success"), id_clientes, id_franquias, '/selecao'
         
-        return dbc.Alert(message, color="danger"), None, None, None, '/'
+        return dbc.Alert(message, color="danger"), None, None, '/'
     
-    return "", None, None, None, '/'
+    return "", None, None, '/'
 
 # Callback 2: "Roteador" - Decide qual página mostrar com base na URL
 @app.callback(
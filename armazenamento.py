@@ -0,0 +1,430 @@
+# armazenamento.py
+# Cache de datasets no lado do servidor. Os dcc.Store do navegador guardam apenas o ID
+# do upload; os DataFrames processados ficam aqui, na memória do processo (LRU limitada
+# por tamanho e com TTL) e em disco, para que todos os workers do gunicorn e os
+# processos dos callbacks em segundo plano enxerguem o mesmo upload.
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# --- CONFIGURAÇÃO (via variáveis de ambiente) ---
+DIRETORIO_CACHE = os.environ.get('NICOPEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nicopel-cache'))
+LIMITE_MEMORIA_MB = int(os.environ.get('NICOPEL_CACHE_MB', '512'))
+LIMITE_DISCO_MB = int(os.environ.get('NICOPEL_CACHE_DISCO_MB', '4096'))
+TTL_SEGUNDOS = int(os.environ.get('NICOPEL_CACHE_TTL', str(6 * 60 * 60)))
+
+# Tipos fixos das colunas conhecidas do relatório "Itens Faturados" no arquivo original
+COLUNAS_DATA = ['Data Emissao']
+COLUNAS_NUMERICAS = ['R$ Total', 'Qtde', 'R$ CM Fat', 'R$ Markup Fat']
+
+
+def novo_id():
+    return uuid.uuid4().hex
+
+
+def _e_id_dataset(nome):
+    """True só para IDs no formato de `novo_id()`; o ID vem do navegador e vira caminho no disco."""
+    return isinstance(nome, str) and len(nome) == 32 and all(c in '0123456789abcdef' for c in nome)
+
+
+def _validar_id(dataset_id):
+    if not _e_id_dataset(dataset_id):
+        raise ValueError(f"ID de dataset inválido: {dataset_id!r}")
+    return dataset_id
+
+
+def preparar_diretorio_cache(diretorio):
+    """Cria o diretório do cache só para o usuário atual (0700).
+
+    O cache guarda pickles, que executam código ao serem lidos: um diretório criado antes por
+    outro usuário (o padrão fica em /tmp) não é aceito.
+    """
+    os.makedirs(diretorio, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.stat(diretorio)
+        if info.st_uid != os.getuid():
+            raise RuntimeError(f"O diretório de cache {diretorio} pertence a outro usuário; "
+                               "defina NICOPEL_CACHE_DIR para uma pasta própria.")
+        if info.st_mode & 0o077:
+            os.chmod(diretorio, 0o700)
+    return diretorio
+
+
+def tamanho_em_bytes(valor):
+    """Estimativa do espaço ocupado por um valor do cache (DataFrames contam em profundidade)."""
+    if valor is None:
+        return 0
+    if hasattr(valor, 'memory_usage'):
+        uso = valor.memory_usage(deep=True)
+        return int(uso.sum()) if hasattr(uso, 'sum') else int(uso)
+    if hasattr(valor, 'nbytes'):
+        return int(valor.nbytes)
+    if hasattr(valor, 'to_plotly_json'):
+        # Figuras do Plotly e componentes do Dash (memorizados pelas páginas): conta os dados que carregam
+        return tamanho_em_bytes(valor.to_plotly_json())
+    if isinstance(valor, dict):
+        return sum(tamanho_em_bytes(v) for v in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sum(tamanho_em_bytes(v) for v in valor)
+    return sys.getsizeof(valor)
+
+
+class CacheDatasets:
+    """Cache LRU de objetos por (dataset_id, nome), limitado em bytes e com expiração por TTL.
+
+    Com `diretorio` definido, cada valor também é gravado em `<diretorio>/<dataset_id>/<nome>.pkl`,
+    e uma ausência na memória é resolvida lendo o disco (útil com vários workers).
+    """
+
+    def __init__(self, limite_bytes, ttl_segundos, diretorio=None, limite_disco_bytes=None):
+        self.limite_bytes = limite_bytes
+        self.ttl_segundos = ttl_segundos
+        self.diretorio = diretorio
+        self.limite_disco_bytes = limite_disco_bytes
+        self._itens = OrderedDict()  # (dataset_id, nome) -> (valor, tamanho, instante)
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        if self.diretorio:
+            preparar_diretorio_cache(self.diretorio)
+
+    # --- MEMÓRIA ---
+    def _remover_da_memoria(self, chave):
+        item = self._itens.pop(chave, None)
+        if item is not None:
+            self._total_bytes -= item[1]
+
+    def _colocar_na_memoria(self, chave, valor):
+        tamanho = tamanho_em_bytes(valor)
+        self._remover_da_memoria(chave)
+        if tamanho > self.limite_bytes:
+            return  # Maior que o cache inteiro: fica apenas no disco (se houver)
+        self._itens[chave] = (valor, tamanho, time.time())
+        self._total_bytes += tamanho
+        while self._total_bytes > self.limite_bytes and self._itens:
+            chave_antiga = next(iter(self._itens))
+            self._remover_da_memoria(chave_antiga)
+
+    # --- DISCO ---
+    def caminho_dataset(self, dataset_id):
+        return os.path.join(self.diretorio, _validar_id(dataset_id)) if self.diretorio else None
+
+    def _caminho(self, dataset_id, nome):
+        return os.path.join(self.diretorio, _validar_id(dataset_id), f'{nome}.pkl')
+
+    def _gravar_no_disco(self, dataset_id, nome, valor):
+        pasta = self.caminho_dataset(dataset_id)
+        os.makedirs(pasta, exist_ok=True)
+        destino = self._caminho(dataset_id, nome)
+        fd, temporario = tempfile.mkstemp(dir=pasta, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as arquivo:
+            pickle.dump(valor, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporario, destino)  # Escrita atômica: outros workers nunca leem um arquivo pela metade
+
+    def _ler_do_disco(self, dataset_id, nome):
+        caminho = self._caminho(dataset_id, nome)
+        try:
+            if time.time() - os.path.getmtime(caminho) > self.ttl_segundos:
+                return None
+            with open(caminho, 'rb') as arquivo:
+                valor = pickle.load(arquivo)
+            os.utime(caminho)  # Marca como usado recentemente (LRU do disco)
+            return valor
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def limpar_disco(self, diretorio=None):
+        """Remove datasets expirados e, se o limite de disco for excedido, os menos usados."""
+        diretorio = diretorio or self.diretorio
+        if not diretorio or not os.path.isdir(diretorio):
+            return
+        agora = time.time()
+        pastas = []
+        for dataset_id in os.listdir(diretorio):
+            pasta = os.path.join(diretorio, dataset_id)
+            # Só pastas de upload; as demais (ex.: `jobs` dos callbacks em segundo plano) ficam
+            if not _e_id_dataset(dataset_id) or not os.path.isdir(pasta):
+                continue
+            arquivos = [os.path.join(raiz, f) for raiz, _, nomes in os.walk(pasta) for f in nomes]
+            ultimo_uso = max((os.path.getmtime(f) for f in arquivos), default=os.path.getmtime(pasta))
+            if agora - ultimo_uso > self.ttl_segundos:
+                shutil.rmtree(pasta, ignore_errors=True)
+                continue
+            pastas.append((ultimo_uso, sum(os.path.getsize(f) for f in arquivos), pasta))
+        if self.limite_disco_bytes:
+            total = sum(tamanho for _, tamanho, _ in pastas)
+            for _, tamanho, pasta in sorted(pastas):
+                if total <= self.limite_disco_bytes:
+                    break
+                shutil.rmtree(pasta, ignore_errors=True)
+                total -= tamanho
+
+    # --- API PÚBLICA ---
+    def guardar(self, dataset_id, nome, valor, em_disco=True):
+        """Guarda `valor`; com `em_disco=False` ele fica só na memória (ex.: resultados memorizados)."""
+        with self._lock:
+            self._colocar_na_memoria((dataset_id, nome), valor)
+        if self.diretorio and em_disco:
+            self._gravar_no_disco(dataset_id, nome, valor)
+
+    def obter(self, dataset_id, nome, em_disco=True):
+        # IDs fora do formato (vazios ou adulterados no navegador) nunca chegam ao disco
+        if not _e_id_dataset(dataset_id):
+            return None
+        chave = (dataset_id, nome)
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None:
+                valor, _, instante = item
+                if time.time() - instante <= self.ttl_segundos:
+                    self._itens.move_to_end(chave)
+                    return valor
+                self._remover_da_memoria(chave)
+        if not self.diretorio or not em_disco:
+            return None
+        valor = self._ler_do_disco(dataset_id, nome)
+        if valor is not None:
+            with self._lock:
+                self._colocar_na_memoria(chave, valor)
+        return valor
+
+    def esquecer(self, condicao):
+        """Tira da memória (o disco fica como está) os itens cuja chave (dataset_id, nome) satisfaz `condicao`."""
+        with self._lock:
+            for chave in [c for c in self._itens if condicao(c)]:
+                self._remover_da_memoria(chave)
+
+    def remover_dataset(self, dataset_id):
+        _validar_id(dataset_id)
+        with self._lock:
+            for chave in [c for c in self._itens if c[0] == dataset_id]:
+                self._remover_da_memoria(chave)
+        shutil.rmtree(os.path.join(self.diretorio or DIRETORIO_CACHE, dataset_id), ignore_errors=True)
+
+
+# O diretório também guarda os arquivos originais, os relatórios e a fila dos jobs em segundo plano
+preparar_diretorio_cache(DIRETORIO_CACHE)
+
+# Instância compartilhada pela aplicação
+cache = CacheDatasets(
+    limite_bytes=LIMITE_MEMORIA_MB * 1024 * 1024,
+    ttl_segundos=TTL_SEGUNDOS,
+    diretorio=DIRETORIO_CACHE,
+    limite_disco_bytes=LIMITE_DISCO_MB * 1024 * 1024,
+)
+
+
+def guardar_dataset(dataset_id, datasets):
+    """Guarda os datasets de um upload ({nome: dataset}) sob o ID curto que vai para os Stores."""
+    cache.limpar_disco()
+    for nome, dataset in datasets.items():
+        if dataset is not None:
+            cache.guardar(dataset_id, nome, dataset)
+    return dataset_id
+
+
+def obter_dataset(dataset_id, nome):
+    return cache.obter(dataset_id, nome)
+
+
+def normalizar_selecao(selecao):
+    """Seleção de filtro como chave de memo: listas viram tuplas ordenadas e vazio/None vira ().
+
+    Tuplas são mantidas como vieram (úteis quando a ordem importa, como na ordenação de tabelas).
+    """
+    if selecao is None:
+        return ()
+    if isinstance(selecao, (list, set)):
+        return tuple(sorted(set(selecao)))
+    return selecao
+
+
+def memoizar_analise(funcao):
+    """Memoriza uma função de análise das páginas por (dataset_id, seleções normalizadas).
+
+    É o filtro e os resumos compartilhados pelo dashboard e pela exportação: baixar o relatório
+    logo após ver o dashboard não recalcula nada. Os resultados ficam no mesmo `cache` dos
+    datasets (só na memória), sob a mesma LRU limitada em bytes: um resultado que referencia
+    o DataFrame do dataset (filtro vazio) é contado por inteiro e sai junto com os demais.
+    Como cada upload tem um ID próprio, um resultado memorizado nunca fica desatualizado.
+    """
+    nome_funcao = f'{funcao.__module__}.{funcao.__qualname__}'
+
+    @functools.wraps(funcao)
+    def envoltorio(dataset_id, *selecoes):
+        chave = (nome_funcao, *(normalizar_selecao(s) for s in selecoes))
+        resultado = cache.obter(dataset_id, chave, em_disco=False)
+        if resultado is None:
+            resultado = funcao(dataset_id, *chave[1:])
+            if resultado is not None and _e_id_dataset(dataset_id):
+                cache.guardar(dataset_id, chave, resultado, em_disco=False)
+        return resultado
+
+    envoltorio.cache_clear = lambda: cache.esquecer(
+        lambda c: isinstance(c[1], tuple) and c[1][:1] == (nome_funcao,))
+    return envoltorio
+
+
+# --- ARQUIVO ORIGINAL (COLUNAR, EM DISCO) ---
+# O upload original é gravado uma única vez em Parquet (strings como dicionário/categoria,
+# datas e números com tipos próprios) e nunca passa por JSON. Cada upload ocupa a pasta
+# `<DIRETORIO_CACHE>/<dataset_id>/original/`, com um arquivo `part-*.parquet` por gravação.
+def pasta_original(dataset_id):
+    return os.path.join(DIRETORIO_CACHE, _validar_id(dataset_id), 'original')
+
+
+def _tipo_coluna_original(nome):
+    nome = nome.strip()
+    if nome in COLUNAS_DATA:
+        return pa.timestamp('us')
+    if nome in COLUNAS_NUMERICAS:
+        return pa.float64()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def tabela_original(df, tipadas=None):
+    """Converte um bloco do arquivo original para Arrow com tipos fixos pelo nome da coluna.
+
+    Datas e valores conhecidos ganham tipo próprio; as demais colunas viram texto codificado
+    como dicionário (categoria no pandas). Como o tipo depende só do nome, todos os blocos de
+    um mesmo upload produzem o mesmo schema. `tipadas` (o bloco já passado por `tipar_bloco`,
+    mesmas linhas) evita converter de novo as datas e valores que a análise já converteu.
+    """
+    tipadas = tipadas if tipadas is not None else pd.DataFrame()
+    colunas, arrays, vistas = [], [], set()
+    for posicao, col in enumerate(df.columns):
+        nome = str(col)
+        tipo = _tipo_coluna_original(nome)
+        serie = df.iloc[:, posicao]
+        # Só a primeira coluna com cada nome vai para a análise (`tipar_bloco` descarta as repetidas)
+        reaproveitar = nome.strip() in tipadas.columns and nome.strip() not in vistas
+        vistas.add(nome.strip())
+        if pa.types.is_timestamp(tipo):
+            serie = tipadas[nome.strip()] if reaproveitar else pd.to_datetime(serie, dayfirst=True, errors='coerce')
+            array = pa.array(serie.astype('datetime64[us]'), type=tipo, from_pandas=True)
+        elif pa.types.is_floating(tipo):
+            serie = tipadas[nome.strip()] if reaproveitar else pd.to_numeric(serie, errors='coerce')
+            array = pa.array(serie.astype('float64'), type=tipo, from_pandas=True)
+        else:
+            array = pc.cast(pa.array(serie.astype('string'), from_pandas=True), pa.string()).dictionary_encode()
+        colunas.append(nome)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=colunas)
+
+
+def contar_partes_original(dataset_id):
+    pasta = pasta_original(dataset_id)
+    if not os.path.isdir(pasta):
+        return 0
+    return len([f for f in os.listdir(pasta) if f.endswith('.parquet')])
+
+
+class EscritorOriginal:
+    """Grava o arquivo original bloco a bloco (um row group por bloco) em um novo `part-*.parquet`.
+
+    `parte` fixa o número do arquivo; é informado quando vários processos gravam ao mesmo tempo.
+    """
+
+    def __init__(self, dataset_id, parte=None):
+        pasta = pasta_original(dataset_id)
+        os.makedirs(pasta, exist_ok=True)
+        if parte is None:
+            parte = contar_partes_original(dataset_id)
+        self.caminho = os.path.join(pasta, f'part-{parte:05d}.parquet')
+        self._escritor = None
+
+    def escrever(self, df_bloco, tipadas=None):
+        tabela = tabela_original(df_bloco, tipadas)
+        if self._escritor is None:
+            self._escritor = pq.ParquetWriter(self.caminho, tabela.schema)
+        self._escritor.write_table(tabela.cast(self._escritor.schema))
+
+    def fechar(self):
+        if self._escritor is not None:
+            self._escritor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+
+def filtrar_parte_original(caminho, manter):
+    """Regrava uma parte do arquivo original apenas com as linhas marcadas em `manter`."""
+    if manter.all():
+        return
+    tabela = pq.read_table(caminho).filter(pa.array(manter))
+    gravar_atomico(caminho, lambda destino: pq.write_table(tabela, destino))
+
+
+def copiar_original(origem_id, destino_id):
+    """Leva as partes do arquivo original de um upload para outro (hard link quando possível)."""
+    origem, destino = pasta_original(origem_id), pasta_original(destino_id)
+    if not os.path.isdir(origem):
+        return
+    os.makedirs(destino, exist_ok=True)
+    for nome in sorted(os.listdir(origem)):
+        if not nome.endswith('.parquet'):
+            continue
+        try:
+            os.link(os.path.join(origem, nome), os.path.join(destino, nome))
+        except OSError:
+            shutil.copy2(os.path.join(origem, nome), os.path.join(destino, nome))
+
+
+def carregar_original(dataset_id, colunas=None, filtros=None):
+    """Lê (via memory-map) o arquivo original de um upload; devolve None se ele não existir mais.
+
+    `filtros` segue o formato do `pyarrow.parquet.read_table` (ex.: `[('FRANQUIA', 'in', [...])]`):
+    só as linhas que passam são convertidas para pandas. As colunas de `colunas` e `filtros` são
+    procuradas sem os espaços das pontas, como na análise; o resultado mantém os nomes do arquivo.
+    """
+    pasta = pasta_original(dataset_id) if _e_id_dataset(dataset_id) else None
+    if not pasta or not os.path.isdir(pasta):
+        return None
+    nomes = {}
+    for nome in pq.ParquetDataset(pasta).schema.names:
+        nomes.setdefault(nome.strip(), nome)
+    if colunas is not None:
+        colunas = [nomes.get(col, col) for col in colunas]
+    if filtros:
+        filtros = [(nomes.get(col, col), operador, valor) for col, operador, valor in filtros]
+    return pq.read_table(pasta, columns=colunas, filters=filtros, memory_map=True).to_pandas()
+
+
+# --- RELATÓRIOS GERADOS ---
+def caminho_relatorio(dataset_id, nome, *selecoes):
+    """Arquivo do relatório `nome` para (dataset, seleção): o mesmo filtro sempre aponta para o mesmo arquivo."""
+    chave = json.dumps([normalizar_selecao(s) for s in selecoes], default=str)
+    resumo = hashlib.sha1(chave.encode('utf-8')).hexdigest()[:16]
+    pasta = os.path.join(DIRETORIO_CACHE, _validar_id(dataset_id), 'relatorios')
+    os.makedirs(pasta, exist_ok=True)
+    return os.path.join(pasta, f'{nome}-{resumo}')
+
+
+def gravar_atomico(caminho, escrever):
+    """Chama `escrever(caminho_temporario)` e só então move o arquivo para `caminho`."""
+    # O temporário mantém a extensão final: alguns escritores (ex.: ExcelWriter) a verificam
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), prefix='.tmp-', suffix=os.path.splitext(caminho)[1])
+    os.close(fd)
+    try:
+        escrever(temporario)
+        os.replace(temporario, caminho)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+    return caminho
@@ -0,0 +1,302 @@
+# benchmarks/benchmark.py
+# Mede o processamento do upload, cada callback das páginas (chamado diretamente) e as
+# exportações sobre arquivos sintéticos no formato do relatório "Itens Faturados".
+#
+# Uso (a partir da raiz do projeto):
+#   python benchmarks/benchmark.py                                  # 10k, 100k e 1M linhas
+#   python benchmarks/benchmark.py --linhas 10000 --salvar-base benchmarks/base.json
+#   python benchmarks/benchmark.py --linhas 10000 --comparar benchmarks/base.json
+#
+# Com --comparar, termina com código 1 se alguma medida ficar mais lenta (ou usar mais
+# memória) que a base além da tolerância. A memória é medida de duas formas: o pico do
+# tracemalloc (só o que passa pelo alocador do Python) e, no Linux, o aumento do pico de
+# memória residente do processo, que também inclui os buffers do pyarrow e do numpy.
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Cache isolado, sem escrever nas pastas do servidor; métricas desligadas para medir só o código
+CACHE_TEMPORARIO = None
+if 'NICOPEL_CACHE_DIR' not in os.environ:
+    CACHE_TEMPORARIO = os.environ['NICOPEL_CACHE_DIR'] = tempfile.mkdtemp(prefix='nicopel-benchmark-')
+os.environ.setdefault('NICOPEL_METRICAS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import app
+from armazenamento import DIRETORIO_CACHE, obter_dataset
+from pages import clientes, franquias
+
+TAMANHOS_PADRAO = [10_000, 100_000, 1_000_000]
+CATEGORIAS = ['CAIXA SORVETE/AÇAI', 'CAIXA DE PIZZA', 'SACOLA', 'COPO', 'GUARDANAPO', 'EMBALAGEM', 'POTE', 'TAMPA']
+
+
+# --- DADOS SINTÉTICOS ---
+def gerar_itens_faturados(linhas, semente=0):
+    """DataFrame com as colunas do "Itens Faturados" (as de `instrucoes_layout` mais FRANQUIA).
+
+    As cardinalidades crescem com o número de linhas, como em exportações reais: mais
+    clientes, itens e notas em arquivos maiores. Sempre o mesmo resultado para a mesma semente.
+    """
+    rng = np.random.default_rng(semente)
+    n_clientes = max(50, linhas // 200)
+    n_itens = max(100, linhas // 1000)
+    documentos = rng.integers(1, max(linhas // 4, 2), linhas)
+    datas = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 730, linhas), unit='D')
+    clientes_linha = rng.integers(0, n_clientes, linhas)
+    return pd.DataFrame({
+        'N° OS': documentos + 100000,
+        'Categoria': rng.choice(CATEGORIAS, linhas),
+        'Descrição Item': np.char.add('ITEM ', rng.integers(0, n_itens, linhas).astype(str)),
+        'Data Emissao': datas.strftime('%d/%m/%Y'),
+        'Cliente Faturamento': np.char.add('CLIENTE ', clientes_linha.astype(str)),
+        'Nome Fantasia': np.char.add('Loja ', clientes_linha.astype(str)),
+        'R$ Total': rng.gamma(2.0, 800.0, linhas).round(2),
+        'CNPJ Cliente': (10 ** 13 + clientes_linha * 7919).astype(str),
+        'Documento': documentos,
+        'Qtde': rng.integers(1, 200, linhas),
+        'R$ CM Fat': rng.uniform(0, 60, linhas).round(4),
+        'R$ Markup Fat': rng.uniform(0.5, 3, linhas).round(4),
+        # Franquia vem do cliente; clientes sem franquia ficam de fora da análise de franquias
+        'FRANQUIA': np.where(clientes_linha % 5 == 0, None, np.char.add('FRANQUIA ', (clientes_linha % 60).astype(str))),
+        'Vendedor': np.char.add('VENDEDOR ', rng.integers(0, 40, linhas).astype(str)),
+    })
+
+
+def como_upload(df, formato):
+    """(contents, filename) como o dcc.Upload entregaria o arquivo."""
+    if formato == 'xlsx':
+        fd, caminho = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            df.to_excel(caminho, index=False)
+            with open(caminho, 'rb') as arquivo:
+                dados = arquivo.read()
+        finally:
+            os.remove(caminho)
+        tipo = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        dados = df.to_csv(index=False).encode('utf-8')
+        tipo = 'text/csv'
+    return f'data:{tipo};base64,' + base64.b64encode(dados).decode('ascii'), f'itens_faturados.{formato}'
+
+
+# --- MEDIÇÃO ---
+FUNCOES_MEMORIZADAS = [clientes.analisa_clientes, clientes.tabela_clientes, clientes.conteudo_aba_clientes,
+                       franquias._categorias_excluidas, franquias.analisa_franquias, franquias.linhas_franquias,
+                       franquias.figuras_franquias]
+
+
+def _limpar_memos():
+    for funcao in FUNCOES_MEMORIZADAS:
+        funcao.cache_clear()
+
+
+# --- MEMÓRIA RESIDENTE (LINUX) ---
+def _memoria_residente():
+    """(RSS atual, pico de RSS) do processo em bytes, lidos de /proc/self/status."""
+    campos = {}
+    with open('/proc/self/status', encoding='ascii') as arquivo:
+        for linha in arquivo:
+            nome, _, valor = linha.partition(':')
+            if nome in ('VmRSS', 'VmHWM'):
+                campos[nome] = int(valor.split()[0]) * 1024
+    return campos['VmRSS'], campos['VmHWM']
+
+
+def _zerar_pico_residente():
+    """Faz o pico de RSS voltar ao RSS atual (Linux >= 4.0); False onde não for possível."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as arquivo:
+            arquivo.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def medir(funcao, repeticoes, memoria, preparar=None):
+    """Menor tempo entre `repeticoes` execuções e, com `memoria`, os picos de memória em execuções extras.
+
+    `pico_memoria_bytes` é o pico do tracemalloc; `pico_rss_bytes` (só no Linux) é quanto a memória
+    residente subiu acima da inicial, medida em outra execução, sem o custo do tracemalloc.
+    `preparar()` roda antes de cada execução, fora da medição (ex.: limpar caches).
+    """
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar:
+            preparar()
+        gc.collect()
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    resultado = {'segundos': min(tempos)}
+    if memoria:
+        if preparar:
+            preparar()
+        gc.collect()
+        # Devolve ao sistema a memória livre do pyarrow, para que a medição a veja ser alocada de novo
+        pa.default_memory_pool().release_unused()
+        if _zerar_pico_residente():
+            inicial, _ = _memoria_residente()
+            funcao()
+            resultado['pico_rss_bytes'] = max(_memoria_residente()[1] - inicial, 0)
+        if preparar:
+            preparar()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            funcao()
+            resultado['pico_memoria_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return resultado
+
+
+def _sem_progresso(_):
+    pass
+
+
+def rodar_cenario(linhas, formato, repeticoes, memoria):
+    """Todas as medidas para um arquivo de `linhas` linhas; devolve {medida: resultado}."""
+    df = gerar_itens_faturados(linhas)
+    contents, filename = como_upload(df, formato)
+    del df
+    medidas = {}
+
+    def processar():
+        dataset_id, dataset_clientes, dataset_franquias, mensagem = app.processar_arquivo_geral(contents, filename)
+        if dataset_id is None:
+            raise RuntimeError(mensagem)
+        return dataset_id, dataset_clientes, dataset_franquias
+
+    medidas['processar_arquivo_geral'] = medir(processar, repeticoes, memoria)
+    # O upload pelo callback também guarda os datasets no cache, como no servidor
+    _, id_clientes, id_franquias, _ = app.processa_e_redireciona(_sem_progresso, contents, filename, None, False, None, None)
+    del contents
+
+    dataset_franquias = obter_dataset(id_franquias, 'franquias')
+    selecao_franquias = dataset_franquias.valores('FRANQUIA')[:5]
+    selecao_itens = dataset_franquias.valores('Descrição Item')[:20]
+    excluir = franquias.CATEGORIAS_EXCLUIR
+    selecao_clientes = obter_dataset(id_clientes, 'clientes').valores('Nome Fantasia')[:50]
+
+    def limpar_relatorios():
+        _limpar_memos()
+        shutil.rmtree(os.path.join(DIRETORIO_CACHE, id_clientes, 'relatorios'), ignore_errors=True)
+        shutil.rmtree(os.path.join(DIRETORIO_CACHE, id_franquias, 'relatorios'), ignore_errors=True)
+
+    chamadas = {
+        'busca_opcoes_clientes': lambda: clientes.busca_opcoes_clientes('loja 1', None, id_clientes),
+        'busca_opcoes_vendedores': lambda: clientes.busca_opcoes_vendedores('vend', None, id_clientes),
+        'atualiza_dash_clientes[visao-geral]': lambda: clientes.atualiza_dash_clientes(None, None, 'visao-geral', id_clientes),
+        'atualiza_dash_clientes[filtrado]': lambda: clientes.atualiza_dash_clientes(selecao_clientes, None, 'visao-geral', id_clientes),
+        'atualiza_dash_clientes[maior-50k]': lambda: clientes.atualiza_dash_clientes(None, None, 'maior-50k', id_clientes),
+        'pagina_clientes_maior_50k': lambda: clientes.pagina_clientes_maior_50k(
+            0, clientes.TAMANHO_PAGINA, [{'column_id': 'Dias Sem Comprar', 'direction': 'desc'}], '', None, None, id_clientes),
+        'pagina_clientes_menor_50k[filtro]': lambda: clientes.pagina_clientes_menor_50k(
+            2, clientes.TAMANHO_PAGINA, None, '{Faturamento Total} > 1000', None, None, id_clientes),
+        'busca_opcoes_franquias': lambda: franquias.busca_opcoes_franquias('franq', None, id_franquias),
+        'busca_opcoes_itens': lambda: franquias.busca_opcoes_itens('item 1', None, id_franquias),
+        'atualiza_dash_franquias': lambda: franquias.atualiza_dash_franquias(selecao_franquias, None, excluir, id_franquias),
+        'atualiza_dash_franquias[itens]': lambda: franquias.atualiza_dash_franquias(selecao_franquias, selecao_itens, excluir, id_franquias),
+    }
+    for nome, chamada in chamadas.items():
+        medidas[nome] = medir(chamada, repeticoes, memoria, preparar=_limpar_memos)
+
+    for formato_exportacao in ('xlsx', 'csv', 'parquet'):
+        medidas[f'gera_excel_clientes[{formato_exportacao}]'] = medir(
+            lambda: clientes.gera_excel_clientes(_sem_progresso, 1, id_clientes, formato_exportacao, None, None),
+            repeticoes, memoria, preparar=limpar_relatorios)
+        medidas[f'gera_excel_franquias[{formato_exportacao}]'] = medir(
+            lambda: franquias.gera_excel_franquias(_sem_progresso, 1, id_franquias, formato_exportacao,
+                                                   selecao_franquias, None, excluir),
+            repeticoes, memoria, preparar=limpar_relatorios)
+    return medidas
+
+
+# --- BASE DE COMPARAÇÃO ---
+# Picos de memória menores que isto são ruído (o RSS reaproveita memória já liberada) e não são comparados
+MEMORIA_MINIMA_COMPARADA = 1024 * 1024
+
+
+def comparar(resultados, base, tolerancia):
+    """Lista de regressões (texto) em relação à base; medidas ausentes em um dos lados são ignoradas."""
+    regressoes = []
+    for cenario, medidas in resultados['cenarios'].items():
+        for nome, atual in medidas.items():
+            anterior = base.get('cenarios', {}).get(cenario, {}).get(nome)
+            if not anterior:
+                continue
+            for campo in ('segundos', 'pico_memoria_bytes', 'pico_rss_bytes'):
+                if campo in atual and anterior.get(campo):
+                    if campo != 'segundos' and max(atual[campo], anterior[campo]) < MEMORIA_MINIMA_COMPARADA:
+                        continue
+                    razao = atual[campo] / anterior[campo]
+                    if razao > 1 + tolerancia:
+                        regressoes.append(f'{cenario} {nome} {campo}: {anterior[campo]:.4g} -> {atual[campo]:.4g} ({razao:.2f}x)')
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do painel Nicopel com dados sintéticos.")
+    parser.add_argument('--linhas', type=int, nargs='+', default=TAMANHOS_PADRAO, help="Tamanhos dos arquivos gerados")
+    parser.add_argument('--formato', choices=['csv', 'xlsx'], default='csv', help="Formato do arquivo enviado")
+    parser.add_argument('--repeticoes', type=int, default=3, help="Execuções por medida (vale a mais rápida)")
+    parser.add_argument('--sem-memoria', action='store_true', help="Não medir os picos de memória (tracemalloc e RSS)")
+    parser.add_argument('--saida', help="Grava os resultados em JSON neste caminho")
+    parser.add_argument('--salvar-base', help="Grava os resultados como nova base neste caminho")
+    parser.add_argument('--comparar', help="Compara com a base gravada neste caminho")
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="Piora aceita antes de acusar regressão (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    resultados = {
+        'ambiente': {'python': platform.python_version(), 'pandas': pd.__version__, 'maquina': platform.platform(),
+                     'formato': args.formato, 'repeticoes': args.repeticoes},
+        'cenarios': {},
+    }
+    for linhas in args.linhas:
+        cenario = f'{args.formato}-{linhas}'
+        print(f"== {cenario}", flush=True)
+        medidas = rodar_cenario(linhas, args.formato, args.repeticoes, not args.sem_memoria)
+        for nome, medida in medidas.items():
+            memoria = ''.join(f"  {medida[campo] / 2 ** 20:9.1f} MB {rotulo}"
+                              for campo, rotulo in (('pico_memoria_bytes', 'py'), ('pico_rss_bytes', 'rss'))
+                              if campo in medida)
+            print(f"  {nome:45s} {medida['segundos'] * 1000:10.1f} ms{memoria}", flush=True)
+        resultados['cenarios'][cenario] = medidas
+
+    for caminho in (args.saida, args.salvar_base):
+        if caminho:
+            with open(caminho, 'w', encoding='utf-8') as arquivo:
+                json.dump(resultados, arquivo, indent=2, ensure_ascii=False)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            regressoes = comparar(resultados, json.load(arquivo), args.tolerancia)
+        if regressoes:
+            print("Regressões em relação à base:")
+            for regressao in regressoes:
+                print("  " + regressao)
+            return 1
+        print("Sem regressões em relação à base.")
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        codigo = main()
+    finally:
+        if CACHE_TEMPORARIO:
+            shutil.rmtree(CACHE_TEMPORARIO, ignore_errors=True)
+    sys.exit(codigo)
@@ -0,0 +1,130 @@
+# dataset.py
+# Representação tipada e indexada de cada análise, construída uma única vez no upload.
+# Os callbacks das páginas filtram por consulta aos índices (valor -> posições das linhas)
+# em vez de decodificar JSON e varrer o DataFrame com `isin` a cada interação.
+import bisect
+import os
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+LIMITE_OPCOES = int(os.environ.get('NICOPEL_LIMITE_OPCOES', '50'))
+
+
+def normalizar_texto(valor):
+    """Texto em minúsculas e sem acentos, para busca ('Açaí' casa com 'acai')."""
+    texto = unicodedata.normalize('NFKD', str(valor).casefold())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+class IndiceBusca:
+    """Opções ordenadas de um dropdown e busca por prefixo (bisect) e por trecho do texto."""
+
+    def __init__(self, valores):
+        self.opcoes = [{'label': str(v), 'value': v} for v in valores]
+        self.normalizados = [normalizar_texto(v) for v in valores]
+        ordem = sorted(range(len(valores)), key=self.normalizados.__getitem__)
+        self._chaves = [self.normalizados[i] for i in ordem]
+        self._ordem = ordem
+
+    def buscar(self, termo, limite=LIMITE_OPCOES):
+        """Até `limite` opções: primeiro as que começam com o termo, depois as que o contêm."""
+        if not termo:
+            return self.opcoes[:limite]
+        termo = normalizar_texto(termo)
+        encontradas = []
+        inicio = bisect.bisect_left(self._chaves, termo)
+        for chave, posicao in zip(self._chaves[inicio:], self._ordem[inicio:]):
+            if not chave.startswith(termo) or len(encontradas) >= limite:
+                break
+            encontradas.append(posicao)
+        if len(encontradas) < limite:
+            ja_incluidas = set(encontradas)
+            for posicao, texto in enumerate(self.normalizados):
+                if termo in texto and posicao not in ja_incluidas:
+                    encontradas.append(posicao)
+                    if len(encontradas) >= limite:
+                        break
+        return [self.opcoes[posicao] for posicao in encontradas]
+
+
+class DatasetAnalise:
+    """DataFrame normalizado (tipos fixos, chaves de texto como categoria) e seus índices de filtro."""
+
+    def __init__(self, df, colunas_categoricas=(), colunas_indexadas=(), colunas_data=(), colunas_busca=()):
+        df = df.reset_index(drop=True)
+        for col in colunas_data:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        for col in colunas_categoricas:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+        self.df = df
+        self.indices = {
+            col: {valor: posicoes.astype(np.int64) for valor, posicoes in df.groupby(col, observed=True, sort=True).indices.items()}
+            for col in colunas_indexadas
+        }
+        # Listas de opções dos dropdowns, montadas uma única vez no upload
+        self.buscas = {col: IndiceBusca(list(self.indices[col])) for col in colunas_busca}
+        self.nbytes = int(df.memory_usage(deep=True).sum()) + sum(
+            p.nbytes for indice in self.indices.values() for p in indice.values()
+        )
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def empty(self):
+        return self.df.empty
+
+    def valores(self, coluna):
+        """Valores distintos (ordenados) de uma coluna indexada."""
+        return list(self.indices[coluna])
+
+    def opcoes(self, coluna, termo=None, selecionados=None, limite=LIMITE_OPCOES):
+        """Opções de dropdown que casam com `termo`, sempre incluindo os valores já selecionados."""
+        opcoes = self.buscas[coluna].buscar(termo, limite)
+        if selecionados:
+            presentes = {opcao['value'] for opcao in opcoes}
+            opcoes = [{'label': str(v), 'value': v} for v in selecionados if v not in presentes] + opcoes
+        return opcoes
+
+    def posicoes(self, filtros):
+        """Posições das linhas que atendem a todos os filtros ({coluna: [valores]}); None = sem filtro."""
+        resultado = None
+        for coluna, selecionados in filtros.items():
+            if not selecionados:
+                continue
+            indice = self.indices[coluna]
+            partes = [indice[v] for v in selecionados if v in indice]
+            encontradas = np.unique(np.concatenate(partes)) if partes else np.empty(0, dtype=np.int64)
+            resultado = encontradas if resultado is None else np.intersect1d(resultado, encontradas, assume_unique=True)
+        return resultado
+
+    def filtrar(self, filtros):
+        posicoes = self.posicoes(filtros)
+        return self.df if posicoes is None else self.df.take(posicoes)
+
+
+# --- CUBO SEMANAL (FRANQUIAS) ---
+DIMENSOES_CUBO = ['FRANQUIA', 'Semana', 'Categoria', 'Vendedor', 'Descrição Item']
+MEDIDAS_CUBO = ['R$ Total', 'Qtde']
+
+
+def semana_de(datas):
+    """Semana de cada data no mesmo rótulo do `resample('W-MON')`: a segunda-feira que fecha a semana."""
+    datas = datas.dt.normalize()
+    return datas + pd.to_timedelta((0 - datas.dt.weekday) % 7, unit='D')
+
+
+def montar_cubo_semanal(df):
+    """Pré-agrega as linhas de franquias por (FRANQUIA, semana, Categoria, Vendedor, Descrição Item).
+
+    As visões do dashboard (ranking, linha semanal, categorias e vendedores) passam a ser somas
+    sobre o cubo, cujo tamanho depende do número de grupos distintos e não do número de linhas.
+    """
+    df = df.assign(Semana=semana_de(df['Data Emissao']))
+    dimensoes = [col for col in DIMENSOES_CUBO if col in df.columns]
+    medidas = [col for col in MEDIDAS_CUBO if col in df.columns]
+    cubo = df.groupby(dimensoes, observed=True, dropna=False, sort=False)[medidas].sum().reset_index()
+    return DatasetAnalise(cubo, colunas_categoricas=['Categoria'], colunas_indexadas=['FRANQUIA', 'Descrição Item'])
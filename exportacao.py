@@ -0,0 +1,94 @@
+# exportacao.py
+# Gravação dos relatórios direto em arquivo. O XLSX usa o modo `constant_memory` do
+# xlsxwriter: cada linha vai para o disco assim que é escrita, em lotes tirados das colunas
+# do DataFrame, sem montar a planilha inteira em memória. CSV e Parquet saem em um .zip
+# com um arquivo por planilha.
+import io
+import os
+import zipfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+
+TAMANHO_LOTE = int(os.environ.get('NICOPEL_LOTE_EXPORTACAO', '10000'))
+
+
+def _lotes(df, tamanho_lote=TAMANHO_LOTE):
+    """Fatias do DataFrame como listas de tuplas de valores Python, com NaN/NaT trocados por None."""
+    for inicio in range(0, len(df), tamanho_lote):
+        lote = df.iloc[inicio:inicio + tamanho_lote].astype(object)
+        yield list(lote.where(lote.notna(), None).itertuples(index=False, name=None))
+
+
+def _avisar(progresso, total_linhas):
+    """Conta as linhas gravadas e repassa a fração do total a `progresso(fracao, texto)`."""
+    gravadas = 0
+
+    def avancar(linhas, nome):
+        nonlocal gravadas
+        gravadas += linhas
+        if progresso:
+            progresso(min(gravadas / max(total_linhas, 1), 1.0), f"Gravando {nome}...")
+    return avancar
+
+
+def escrever_xlsx(destino, planilhas, progresso=None):
+    """Grava [(nome, DataFrame)] como abas de um XLSX em `destino`, linha a linha."""
+    avancar = _avisar(progresso, sum(len(df) for _, df in planilhas))
+    livro = xlsxwriter.Workbook(destino, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+    try:
+        for nome, df in planilhas:
+            aba = livro.add_worksheet(nome)
+            aba.write_row(0, 0, [str(col) for col in df.columns])
+            linha = 1
+            for lote in _lotes(df):
+                for valores in lote:
+                    aba.write_row(linha, 0, valores)
+                    linha += 1
+                avancar(len(lote), nome)
+    finally:
+        livro.close()
+
+
+def escrever_csv_zip(destino, planilhas, progresso=None):
+    """Grava [(nome, DataFrame)] como `<nome>.csv` dentro de um .zip em `destino`."""
+    avancar = _avisar(progresso, sum(len(df) for _, df in planilhas))
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_DEFLATED) as arquivo_zip:
+        for nome, df in planilhas:
+            with arquivo_zip.open(f'{nome}.csv', 'w') as membro, \
+                    io.TextIOWrapper(membro, encoding='utf-8-sig', newline='') as texto:
+                df.iloc[:0].to_csv(texto, index=False)
+                for inicio in range(0, len(df), TAMANHO_LOTE):
+                    lote = df.iloc[inicio:inicio + TAMANHO_LOTE]
+                    lote.to_csv(texto, index=False, header=False, date_format='%Y-%m-%d')
+                    avancar(len(lote), nome)
+
+
+def escrever_parquet_zip(destino, planilhas, progresso=None):
+    """Grava [(nome, DataFrame)] como `<nome>.parquet` dentro de um .zip em `destino`."""
+    avancar = _avisar(progresso, sum(len(df) for _, df in planilhas))
+    # O Parquet já vem comprimido: o zip só agrupa os arquivos
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as arquivo_zip:
+        for nome, df in planilhas:
+            # Schema do DataFrame inteiro: um lote só com vazios não muda o tipo da coluna
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            with arquivo_zip.open(f'{nome}.parquet', 'w') as membro, pq.ParquetWriter(membro, schema) as escritor:
+                for inicio in range(0, len(df), TAMANHO_LOTE):
+                    lote = df.iloc[inicio:inicio + TAMANHO_LOTE]
+                    escritor.write_table(pa.Table.from_pandas(lote, schema=schema, preserve_index=False))
+                    avancar(len(lote), nome)
+
+
+# Formatos oferecidos no download: extensão do arquivo e função que o grava
+FORMATOS = {
+    'xlsx': ('.xlsx', escrever_xlsx),
+    'csv': ('.csv.zip', escrever_csv_zip),
+    'parquet': ('.parquet.zip', escrever_parquet_zip),
+}
+
+OPCOES_FORMATO = [
+    {'label': 'Excel (.xlsx)', 'value': 'xlsx'},
+    {'label': 'CSV (.zip)', 'value': 'csv'},
+    {'label': 'Parquet (.zip)', 'value': 'parquet'},
+]
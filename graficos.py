@@ -0,0 +1,76 @@
+# graficos.py
+# Gráficos de linha com payload limitado. Séries longas são reduzidas no servidor com LTTB
+# (Largest-Triangle-Three-Buckets, que preserva picos e vales) a um orçamento de pontos
+# dividido entre as séries, e acima de um limite de pontos o traço passa a WebGL
+# (`Scattergl`, sem marcadores). Quando nem o mínimo de pontos por série cabe no orçamento,
+# só as maiores séries são desenhadas e as demais são somadas em "Outras". Assim o JSON da
+# figura e o tempo de desenho no navegador não crescem com o número de franquias selecionadas.
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Total de pontos enviados por gráfico (somando todas as séries); ~ largura do gráfico em pixels por série
+ORCAMENTO_PONTOS = int(os.environ.get('NICOPEL_PONTOS_GRAFICO', '4000'))
+# Nenhuma série é reduzida abaixo disto, por mais séries que haja
+MINIMO_PONTOS_SERIE = int(os.environ.get('NICOPEL_PONTOS_MINIMOS_SERIE', '60'))
+# A partir deste total de pontos o gráfico usa WebGL
+LIMITE_WEBGL = int(os.environ.get('NICOPEL_LIMITE_WEBGL', '1000'))
+# Séries desenhadas (contando "Outras"): o máximo em que todas ainda ganham o mínimo de pontos
+MAXIMO_SERIES = max(1, ORCAMENTO_PONTOS // MINIMO_PONTOS_SERIE)
+NOME_OUTRAS = 'Outras'
+
+
+def lttb(x, y, limite):
+    """Posições dos `limite` pontos escolhidos pelo LTTB; todas as posições se a série já couber.
+
+    `x` pode ser numérico ou datetime64; os pontos devem estar ordenados por `x`.
+    """
+    n = len(y)
+    if limite >= n or limite < 3:
+        return np.arange(n)
+    xs = np.asarray(x)
+    xs = (xs.astype('datetime64[ns]').astype(np.int64) if np.issubdtype(xs.dtype, np.datetime64) else xs).astype(np.float64)
+    ys = np.asarray(y, dtype=np.float64)
+    # limite - 2 baldes entre o primeiro e o último ponto, que são sempre mantidos
+    bordas = np.linspace(1, n - 1, limite - 1).astype(np.int64)
+    escolhidos = np.empty(limite, dtype=np.int64)
+    escolhidos[0], escolhidos[-1] = 0, n - 1
+    anterior = 0
+    for i in range(limite - 2):
+        inicio, fim = bordas[i], bordas[i + 1]
+        prox_inicio, prox_fim = bordas[i + 1], (bordas[i + 2] if i + 2 < len(bordas) else n)
+        media_x, media_y = xs[prox_inicio:prox_fim].mean(), ys[prox_inicio:prox_fim].mean()
+        # Ponto do balde que forma o maior triângulo com o último escolhido e a média do próximo balde
+        areas = np.abs((xs[anterior] - media_x) * (ys[inicio:fim] - ys[anterior])
+                       - (xs[anterior] - xs[inicio:fim]) * (media_y - ys[anterior]))
+        anterior = inicio + int(areas.argmax())
+        escolhidos[i + 1] = anterior
+    return escolhidos
+
+
+def grafico_linhas(df, x, y, cor, titulo, template='plotly_white'):
+    """Equivalente ao `px.line(df, x, y, color=cor, markers=True)` com o número de pontos limitado."""
+    grupos = [(nome, grupo.sort_values(x)) for nome, grupo in df.groupby(cor, observed=True, sort=False)]
+    if len(grupos) > MAXIMO_SERIES:
+        # As de maior soma de `y` ficam; as demais viram uma série só, somada por `x`
+        grupos.sort(key=lambda item: item[1][y].sum(), reverse=True)
+        restantes = pd.concat([grupo for _, grupo in grupos[MAXIMO_SERIES - 1:]])
+        grupos = grupos[:MAXIMO_SERIES - 1] + [(NOME_OUTRAS, restantes.groupby(x, as_index=False)[y].sum())]
+    limite_serie = max(MINIMO_PONTOS_SERIE, ORCAMENTO_PONTOS // max(len(grupos), 1))
+    series = []
+    for nome, grupo in grupos:
+        posicoes = lttb(grupo[x].to_numpy(), grupo[y].to_numpy(), limite_serie)
+        series.append((nome, grupo[x].to_numpy()[posicoes], grupo[y].to_numpy()[posicoes]))
+
+    webgl = sum(len(valores_x) for _, valores_x, _ in series) > LIMITE_WEBGL
+    Traco = go.Scattergl if webgl else go.Scatter
+    fig = go.Figure([
+        Traco(x=valores_x, y=valores_y, name=str(nome), legendgroup=str(nome),
+              mode='lines' if webgl else 'lines+markers',
+              hovertemplate=f'{cor}={nome}<br>{x}=%{{x}}<br>{y}=%{{y}}<extra></extra>')
+        for nome, valores_x, valores_y in series
+    ])
+    return fig.update_layout(title=titulo, title_x=0.5, template=template, legend_title_text=cor,
+                             xaxis_title=x, yaxis_title=y)
@@ -1,7 +1,20 @@
 # app.py
+import os
+
 import dash
 import dash_bootstrap_components as dbc
+import diskcache
+
+import metricas
+from armazenamento import DIRETORIO_CACHE
+
+# Processamento de uploads e geração de relatórios rodam em segundo plano, fora do worker do gunicorn
+background_callback_manager = dash.DiskcacheManager(diskcache.Cache(os.path.join(DIRETORIO_CACHE, 'jobs')))
 
 # Inicializa a aplicação Dash. Esta instância 'app' será importada por outros arquivos.
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.LITERA], suppress_callback_exceptions=True)
-server = app.server
\ No newline at end of file
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.LITERA], suppress_callback_exceptions=True,
+                background_callback_manager=background_callback_manager)
+server = app.server
+
+# Tempo, tamanho das mensagens e memória de cada callback, publicados em /metrics
+metricas.instrumentar(app)
\ No newline at end of file
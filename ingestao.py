@@ -0,0 +1,336 @@
+# ingestao.py
+# Leitura em blocos dos uploads. O conteúdo base64 é decodificado direto para um arquivo
+# temporário, o CSV é lido com `chunksize` e o XLSX em modo somente leitura do openpyxl.
+# Cada bloco é tipado, gravado no arquivo original (Parquet) e reduzido às colunas das
+# análises; os agregados por cliente são acumulados bloco a bloco. Assim o pico de memória
+# acompanha o tamanho do bloco, não o do arquivo. Vários arquivos de um mesmo upload são
+# lidos em paralelo, um por processo (`ler_arquivo_tipado`).
+import base64
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import tempfile
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+
+from armazenamento import COLUNAS_DATA, COLUNAS_NUMERICAS, EscritorOriginal
+
+TAMANHO_BLOCO = int(os.environ.get('NICOPEL_TAMANHO_BLOCO', '50000'))
+# Processos usados para ler os arquivos de um upload com vários arquivos
+PROCESSOS_LEITURA = int(os.environ.get('NICOPEL_PROCESSOS_LEITURA', str(min(os.cpu_count() or 1, 8))))
+
+# Colunas exigidas por cada análise
+COLUNAS_CLIENTES = ['Data Emissao', 'R$ Total', 'Nome Fantasia', 'Vendedor']
+COLUNAS_FRANQUIAS = ['Data Emissao', 'R$ Total', 'FRANQUIA', 'Descrição Item', 'Categoria']
+# Colunas usadas pelo dashboard de franquias quando presentes no arquivo
+COLUNAS_FRANQUIAS_OPCIONAIS = ['Nome Fantasia', 'Vendedor', 'Qtde']
+# Identificam uma linha do faturamento; usadas para descartar linhas repetidas no modo incremental
+COLUNAS_CHAVE_LINHA = ['Documento', 'N° OS', 'Descrição Item']
+# Sem ao menos uma destas, as colunas restantes (ex.: só o item) não identificam a linha
+COLUNAS_CHAVE_OBRIGATORIAS = ['Documento', 'N° OS']
+
+
+def decodificar_para_arquivo(contents, filename):
+    """Decodifica o `contents` do dcc.Upload em fatias para um arquivo temporário e devolve o caminho."""
+    inicio = contents.index(',') + 1
+    sufixo = os.path.splitext(filename)[1] or '.tmp'
+    fd, caminho = tempfile.mkstemp(suffix=sufixo)
+    fatia = 4 * 1024 * 1024  # múltiplo de 4: cada fatia base64 decodifica de forma independente
+    with os.fdopen(fd, 'wb') as arquivo:
+        for pos in range(inicio, len(contents), fatia):
+            arquivo.write(base64.b64decode(contents[pos:pos + fatia]))
+    return caminho
+
+
+def _blocos_xlsx(caminho, tamanho_bloco, progresso):
+    livro = openpyxl.load_workbook(caminho, read_only=True, data_only=True)
+    try:
+        planilha = livro.worksheets[0]
+        total_linhas = planilha.max_row or 0  # vem da dimensão gravada no arquivo; pode faltar
+        linhas = planilha.iter_rows(values_only=True)
+        cabecalho = next(linhas, ())
+        colunas = [str(col) if col is not None else f'Unnamed: {i}' for i, col in enumerate(cabecalho)]
+        bloco, lidas, gerados = [], 0, 0
+        for linha in linhas:
+            lidas += 1
+            if all(valor is None for valor in linha):
+                continue
+            bloco.append(tuple(linha[:len(colunas)]) + (None,) * (len(colunas) - len(linha)))
+            if len(bloco) >= tamanho_bloco:
+                yield pd.DataFrame(bloco, columns=colunas)
+                bloco, gerados = [], gerados + 1
+                if progresso and total_linhas:
+                    progresso(min(lidas / total_linhas, 1.0))
+        # Como no CSV, uma planilha só com o cabeçalho gera um bloco vazio com as colunas
+        if bloco or not gerados:
+            yield pd.DataFrame(bloco, columns=colunas)
+    finally:
+        livro.close()
+
+
+def ler_blocos(caminho, filename, tamanho_bloco=TAMANHO_BLOCO, progresso=None):
+    """Gera DataFrames de até `tamanho_bloco` linhas, com as colunas como vieram no arquivo.
+
+    `progresso`, se informado, recebe a fração aproximada do arquivo já lida após cada bloco.
+    """
+    nome = filename.lower()
+    if nome.endswith('.xls'):
+        # Formato antigo não tem leitura em streaming: lê de uma vez e devolve em fatias
+        df = pd.read_excel(caminho, dtype=object)
+        for inicio in range(0, max(len(df), 1), tamanho_bloco):
+            yield df.iloc[inicio:inicio + tamanho_bloco]
+            if progresso and len(df):
+                progresso(min((inicio + tamanho_bloco) / len(df), 1.0))
+    elif 'xls' in nome:
+        yield from _blocos_xlsx(caminho, tamanho_bloco, progresso)
+    else:
+        # Tudo como texto: os tipos são aplicados por nome de coluna, igual em todos os blocos
+        tamanho_arquivo = os.path.getsize(caminho) or 1
+        with open(caminho, 'rb') as arquivo:
+            vazio = True
+            for bloco in pd.read_csv(arquivo, chunksize=tamanho_bloco, dtype=str, encoding='utf-8'):
+                vazio = False
+                yield bloco
+                if progresso:
+                    progresso(min(arquivo.tell() / tamanho_arquivo, 1.0))
+        if vazio:
+            yield pd.read_csv(caminho, nrows=0, dtype=str, encoding='utf-8')
+
+
+def _como_texto(serie):
+    if pd.api.types.is_string_dtype(serie):
+        return serie
+    return serie.astype(object).map(lambda v: v if pd.isna(v) else str(v)).astype('str')
+
+
+def tipar_bloco(bloco, colunas):
+    """Remove espaços dos nomes, mantém só `colunas` (as que existirem) e aplica os tipos da análise."""
+    bloco = bloco.rename(columns=lambda col: str(col).strip())
+    bloco = bloco.loc[:, ~bloco.columns.duplicated()]
+    bloco = bloco[[col for col in colunas if col in bloco.columns]].copy()
+    for col in bloco.columns:
+        if col in COLUNAS_DATA:
+            bloco[col] = pd.to_datetime(bloco[col], dayfirst=True, errors='coerce')
+        elif col in COLUNAS_NUMERICAS:
+            bloco[col] = pd.to_numeric(bloco[col], errors='coerce')
+        else:
+            bloco[col] = _como_texto(bloco[col])
+    return bloco
+
+
+def colunas_comuns(caminhos_tipados, colunas):
+    """Colunas de `colunas` presentes em algum dos arquivos tipados (arquivos distintos podem diferir)."""
+    presentes = set().union(*(pq.read_schema(caminho).names for caminho in caminhos_tipados))
+    return [col for col in colunas if col in presentes]
+
+
+def blocos_tipados(caminho_tipado, colunas, tamanho_bloco=TAMANHO_BLOCO):
+    """Lê de volta, bloco a bloco, um arquivo gravado por `ler_arquivo_tipado`, com exatamente `colunas`."""
+    for lote in pq.ParquetFile(caminho_tipado).iter_batches(batch_size=tamanho_bloco):
+        bloco = lote.to_pandas()
+        yield bloco if list(bloco.columns) == colunas else tipar_bloco(bloco.reindex(columns=colunas), colunas)
+
+
+# --- LEITURA PARALELA (UPLOAD COM VÁRIOS ARQUIVOS) ---
+def ler_arquivo_tipado(contents, filename, colunas, dataset_id, parte):
+    """Decodifica e lê um arquivo inteiro; roda em um processo do pool.
+
+    Grava as linhas como vieram na parte `parte` do arquivo original e os blocos tipados (só
+    `colunas`) em um Parquet temporário, na mesma ordem de linhas. Devolve os dois caminhos: o
+    processo principal lê os blocos com `blocos_tipados` sem receber o arquivo inteiro por pickle.
+    """
+    caminho = decodificar_para_arquivo(contents, filename)
+    fd, caminho_tipado = tempfile.mkstemp(suffix='.parquet')
+    os.close(fd)
+    escritor = None
+    try:
+        with EscritorOriginal(dataset_id, parte) as original:
+            for bloco in ler_blocos(caminho, filename):
+                bloco_tipado = tipar_bloco(bloco, colunas)
+                original.escrever(bloco, bloco_tipado)
+                tabela = pa.Table.from_pandas(bloco_tipado, preserve_index=False)
+                if escritor is None:
+                    escritor = pq.ParquetWriter(caminho_tipado, tabela.schema)
+                escritor.write_table(tabela.cast(escritor.schema))
+        if escritor is None:
+            # Nenhum bloco lido: ainda assim um Parquet válido (sem linhas) para `colunas_comuns` ler o schema
+            vazio = tipar_bloco(pd.DataFrame(), colunas)
+            pq.write_table(pa.Table.from_pandas(vazio, preserve_index=False), caminho_tipado)
+        return original.caminho, caminho_tipado
+    except BaseException:
+        os.remove(caminho_tipado)
+        raise
+    finally:
+        if escritor is not None:
+            escritor.close()
+        os.remove(caminho)
+
+
+def ler_arquivos_em_paralelo(arquivos, colunas, dataset_id, primeira_parte=0, progresso=None):
+    """Lê vários (contents, filename) em paralelo; devolve [(caminho da parte, caminho tipado)] na ordem recebida.
+
+    Os arquivos tipados são temporários: quem chama os remove depois de lê-los.
+    `progresso`, se informado, recebe a fração de arquivos já lidos.
+    """
+    resultados = [None] * len(arquivos)
+    with ProcessPoolExecutor(max_workers=max(1, min(PROCESSOS_LEITURA, len(arquivos)))) as pool:
+        futuros = {
+            pool.submit(ler_arquivo_tipado, contents, filename, colunas, dataset_id, primeira_parte + i): i
+            for i, (contents, filename) in enumerate(arquivos)
+        }
+        try:
+            for concluidos, futuro in enumerate(as_completed(futuros), start=1):
+                resultados[futuros[futuro]] = futuro.result()
+                if progresso:
+                    progresso(concluidos / len(arquivos))
+        except BaseException:
+            # Espera os arquivos já em leitura para apagar os temporários que eles gravaram
+            pool.shutdown(wait=True, cancel_futures=True)
+            remover_tipados(futuro.result()[1] for futuro in futuros
+                            if not futuro.cancelled() and futuro.exception() is None)
+            raise
+    return resultados
+
+
+def remover_tipados(caminhos_tipados):
+    """Apaga os arquivos temporários devolvidos por `ler_arquivos_em_paralelo`."""
+    for caminho in caminhos_tipados:
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+
+def chaves_linhas(bloco):
+    """Hash (uint64) por linha das colunas de COLUNAS_CHAVE_LINHA presentes no bloco.
+
+    None se o bloco não tiver `Documento` nem `N° OS`: aí não há como saber se uma linha se repete.
+    """
+    if not any(col in bloco.columns for col in COLUNAS_CHAVE_OBRIGATORIAS):
+        return None
+    colunas = [col for col in COLUNAS_CHAVE_LINHA if col in bloco.columns]
+    return pd.util.hash_pandas_object(bloco[colunas], index=False).to_numpy()
+
+
+class FiltroLinhasRepetidas:
+    """Descarta linhas cuja chave já existe no conjunto anterior (modo incremental).
+
+    As linhas de um mesmo arquivo não são comparadas entre si, como no processamento completo;
+    entre arquivos de um mesmo upload, `consolidar()` após cada um descarta as repetidas.
+    """
+
+    def __init__(self, chaves_existentes=None, sem_chave=False):
+        self.chaves_existentes = chaves_existentes if chaves_existentes is not None else np.empty(0, dtype=np.uint64)
+        self.novas = []
+        self.descartadas = 0
+        # Algum bloco (deste upload ou do conjunto anterior, via `sem_chave`) veio sem colunas de chave
+        self.sem_chave = sem_chave
+
+    def linhas_novas(self, bloco):
+        """Máscara booleana das linhas do bloco que ainda não existem no conjunto."""
+        chaves = chaves_linhas(bloco)
+        if chaves is None:
+            self.sem_chave = self.sem_chave or len(bloco) > 0
+            return np.ones(len(bloco), dtype=bool)
+        novas = np.ones(len(chaves), dtype=bool)
+        if len(self.chaves_existentes):
+            posicoes = np.searchsorted(self.chaves_existentes, chaves).clip(max=len(self.chaves_existentes) - 1)
+            novas = self.chaves_existentes[posicoes] != chaves
+        self.novas.append(chaves[novas])
+        self.descartadas += int(len(novas) - novas.sum())
+        return novas
+
+    def resultado(self):
+        """Chaves ordenadas de todas as linhas do conjunto (anteriores + novas)."""
+        return np.unique(np.concatenate([self.chaves_existentes, *self.novas]))
+
+    def consolidar(self):
+        """Passa as chaves novas para o conjunto existente: o próximo arquivo também é comparado com elas."""
+        self.chaves_existentes = self.resultado()
+        self.novas = []
+
+
+class AcumuladorClientes:
+    """Agregados por cliente (faturamento, última compra e seu vendedor) acumulados bloco a bloco."""
+
+    def __init__(self):
+        self.faturamento = pd.Series(dtype='float64')
+        self.ultimas = pd.DataFrame(columns=['Nome Fantasia', 'Data Emissao', 'Vendedor'])
+        self.data_max = pd.NaT
+
+    @classmethod
+    def a_partir_de(cls, df_clientes):
+        """Retoma a acumulação a partir do resultado de um processamento anterior."""
+        acumulador = cls()
+        nomes = df_clientes['Nome Fantasia'].astype(str).to_numpy()
+        acumulador.faturamento = pd.Series(df_clientes['Faturamento Total'].to_numpy(), index=nomes, dtype='float64')
+        acumulador.ultimas = pd.DataFrame({
+            'Nome Fantasia': nomes,
+            'Data Emissao': df_clientes['Ultima Compra'].to_numpy(),
+            'Vendedor': df_clientes['Vendedor da Ultima Compra'].astype(str).to_numpy(),
+        })
+        # A última compra mais recente entre os clientes é a data máxima do conjunto
+        acumulador.data_max = df_clientes['Ultima Compra'].max()
+        return acumulador
+
+    def adicionar(self, bloco):
+        df_cl = bloco.dropna(subset=COLUNAS_CLIENTES)
+        if df_cl.empty:
+            return
+        parcial = df_cl.groupby('Nome Fantasia', sort=False)['R$ Total'].sum()
+        self.faturamento = parcial if self.faturamento.empty else self.faturamento.add(parcial, fill_value=0)
+        ultimas = df_cl[['Nome Fantasia', 'Data Emissao', 'Vendedor']]
+        if not self.ultimas.empty:
+            ultimas = pd.concat([self.ultimas, ultimas], ignore_index=True)
+        # Ordenação estável: em empate de data vale a linha mais recente do arquivo
+        self.ultimas = ultimas.sort_values('Data Emissao', kind='stable').drop_duplicates('Nome Fantasia', keep='last')
+        data_max = df_cl['Data Emissao'].max()
+        self.data_max = data_max if pd.isna(self.data_max) else max(self.data_max, data_max)
+
+    def resultado(self):
+        """DataFrame final por cliente, no mesmo formato do processamento em memória; None se vazio."""
+        if self.faturamento.empty:
+            return None
+        faturamento_total = self.faturamento.sort_index().rename('Faturamento Total').rename_axis('Nome Fantasia').reset_index()
+        ultimas_compras = self.ultimas.rename(columns={'Data Emissao': 'Ultima Compra', 'Vendedor': 'Vendedor da Ultima Compra'})
+        df_clientes = pd.merge(faturamento_total, ultimas_compras, on='Nome Fantasia')
+        df_clientes['Dias Sem Comprar'] = (self.data_max - df_clientes['Ultima Compra']).dt.days
+        return df_clientes
+
+
+class AcumuladorFranquias:
+    """Linhas válidas para a análise de franquias, guardadas por bloco com texto já categorizado."""
+
+    def __init__(self, colunas, df_existente=None):
+        self.colunas = colunas
+        self.blocos = [] if df_existente is None else [df_existente]
+
+    def adicionar(self, bloco):
+        # O primeiro bloco (ou o conjunto anterior) fixa as colunas; as que faltarem nos seguintes ficam vazias
+        colunas = list(self.blocos[0].columns) if self.blocos else [col for col in self.colunas if col in bloco.columns]
+        df_fr = bloco.dropna(subset=COLUNAS_FRANQUIAS).reindex(columns=colunas)
+        for col in df_fr.columns:
+            if col not in COLUNAS_DATA and col not in COLUNAS_NUMERICAS:
+                # Coluna ausente vem como float: vira texto para as categorias unirem com as dos outros blocos
+                serie = df_fr[col] if col in bloco.columns else df_fr[col].astype('str')
+                df_fr[col] = serie.astype('category')
+        self.blocos.append(df_fr)
+
+    def resultado(self):
+        if not self.blocos:
+            return None
+        colunas = self.blocos[0].columns
+        dados = {}
+        for col in colunas:
+            partes = [bloco[col] for bloco in self.blocos]
+            if isinstance(partes[0].dtype, pd.CategoricalDtype):
+                # Une as categorias sem materializar o texto de todas as linhas
+                dados[col] = pd.Series(union_categoricals(partes, ignore_order=True))
+            else:
+                dados[col] = pd.concat(partes, ignore_index=True)
+        self.blocos = []
+        return pd.DataFrame(dados, columns=colunas)
@@ -0,0 +1,201 @@
+# metricas.py
+# Medição de tempo, tamanho das mensagens e memória dos callbacks e das etapas do
+# processamento. Os números ficam em um diskcache no diretório de cache, para que o
+# processo do servidor, os workers do gunicorn e os processos dos callbacks em segundo
+# plano somem nos mesmos contadores; `/metrics` os expõe no formato texto do Prometheus.
+import contextlib
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+import diskcache
+from flask import Response, g, request
+
+from armazenamento import DIRETORIO_CACHE
+
+# --- CONFIGURAÇÃO (via variáveis de ambiente) ---
+METRICAS_ATIVAS = os.environ.get('NICOPEL_METRICAS', '1') != '0'
+# Callbacks acima deste tempo são registrados no log (0 = desligado)
+LIMITE_LENTO_MS = int(os.environ.get('NICOPEL_CALLBACK_LENTO_MS', '0'))
+# Pico de memória por callback/etapa via tracemalloc (deixa o Python mais lento; use ao investigar)
+USAR_TRACEMALLOC = os.environ.get('NICOPEL_TRACEMALLOC', '0') == '1'
+# Por padrão `/metrics` só responde a requisições da própria máquina
+METRICAS_PUBLICAS = os.environ.get('NICOPEL_METRICAS_PUBLICAS', '0') == '1'
+
+ROTA_CALLBACKS = '/_dash-update-component'
+log = logging.getLogger('nicopel.metricas')
+
+
+class RegistroMetricas:
+    """Contadores (contagem, soma, máximo) por (tipo, nome), compartilhados entre processos."""
+
+    def __init__(self, diretorio):
+        self._diretorio = diretorio
+        self._cache = None
+
+    @property
+    def cache(self):
+        # Aberto sob demanda: cada processo (inclusive os criados por fork) abre a sua conexão
+        if self._cache is None:
+            self._cache = diskcache.Cache(self._diretorio)
+        return self._cache
+
+    def registrar(self, tipo, nome, segundos, bytes_entrada=0, bytes_saida=0, pico_memoria=0):
+        prefixo = f'{tipo}|{nome}|'
+        cache = self.cache
+        with cache.transact():
+            cache.incr(prefixo + 'contagem')
+            cache.incr(prefixo + 'microssegundos', int(segundos * 1e6))
+            cache.incr(prefixo + 'bytes_entrada', int(bytes_entrada))
+            cache.incr(prefixo + 'bytes_saida', int(bytes_saida))
+            for campo, valor in (('max_microssegundos', int(segundos * 1e6)), ('pico_memoria', int(pico_memoria))):
+                if valor > cache.get(prefixo + campo, 0):
+                    cache.set(prefixo + campo, valor)
+
+    def valores(self):
+        """{(tipo, nome): {campo: valor}} com tudo o que já foi registrado."""
+        resultado = {}
+        for chave in self.cache.iterkeys():
+            tipo, nome, campo = chave.split('|', 2)
+            valor = self.cache.get(chave)
+            if valor is not None:
+                resultado.setdefault((tipo, nome), {})[campo] = valor
+        return resultado
+
+    def limpar(self):
+        self.cache.clear()
+
+
+registro = RegistroMetricas(os.path.join(DIRETORIO_CACHE, 'metricas'))
+
+
+# --- MEDIÇÃO ---
+_local = threading.local()
+
+
+def _iniciar_medicao():
+    """Marca o início de uma medição; com tracemalloc, zera o pico guardando o da medição externa."""
+    if USAR_TRACEMALLOC:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        picos = getattr(_local, 'picos', None)
+        if picos is None:
+            picos = _local.picos = []
+        if picos:
+            picos[-1] = max(picos[-1], tracemalloc.get_traced_memory()[1])
+        picos.append(0)
+        tracemalloc.reset_peak()
+    return time.perf_counter()
+
+
+def _encerrar_medicao(inicio):
+    """Devolve (segundos, pico de memória em bytes) desde `_iniciar_medicao`."""
+    segundos = time.perf_counter() - inicio
+    pico = 0
+    if USAR_TRACEMALLOC and tracemalloc.is_tracing() and getattr(_local, 'picos', None):
+        pico = max(_local.picos.pop(), tracemalloc.get_traced_memory()[1])
+        # O pico de uma etapa interna também conta para a etapa que a contém
+        if _local.picos:
+            _local.picos[-1] = max(_local.picos[-1], pico)
+    return segundos, pico
+
+
+@contextlib.contextmanager
+def etapa(nome):
+    """Mede um trecho do processamento: `with etapa('leitura'): ...`."""
+    if not METRICAS_ATIVAS:
+        yield
+        return
+    inicio = _iniciar_medicao()
+    try:
+        yield
+    finally:
+        segundos, pico = _encerrar_medicao(inicio)
+        try:
+            registro.registrar('etapa', nome, segundos, pico_memoria=pico)
+        except Exception:
+            log.exception("Falha ao registrar a métrica da etapa %s", nome)
+
+
+def memoria_maxima_processo():
+    """Pico de memória residente (bytes) do processo atual."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# --- INTEGRAÇÃO COM O DASH/FLASK ---
+def _nome_callback(app, corpo):
+    saida = (corpo or {}).get('output', '')
+    funcao = app.callback_map.get(saida, {}).get('callback')
+    return getattr(funcao, '__name__', saida) or 'desconhecido'
+
+
+# Séries publicadas: (sufixo, tipo no Prometheus, ajuda, campo registrado, escala, tipos de medição)
+SERIES = [
+    ('segundos_max', 'gauge', 'maior tempo de parede observado', 'max_microssegundos', 1e-6, ('callback', 'etapa')),
+    ('bytes_entrada_total', 'counter', 'bytes recebidos', 'bytes_entrada', 1, ('callback',)),
+    ('bytes_saida_total', 'counter', 'bytes enviados', 'bytes_saida', 1, ('callback',)),
+    ('pico_memoria_bytes', 'gauge', 'maior pico de memória (tracemalloc)', 'pico_memoria', 1, ('callback', 'etapa')),
+]
+TIPOS = {'callback': ('nicopel_callback', 'Callbacks do Dash'), 'etapa': ('nicopel_etapa', 'Etapas do processamento')}
+
+
+def formatar_prometheus(valores):
+    """Texto no formato de exposição do Prometheus para o resultado de `registro.valores()`."""
+    linhas = []
+    for tipo, (prefixo, descricao) in TIPOS.items():
+        itens = sorted((nome, campos) for (t, nome), campos in valores.items() if t == tipo)
+        etiquetas = ['{%s="%s"}' % (tipo, nome.replace('\\', '\\\\').replace('"', '\\"')) for nome, _ in itens]
+        linhas += [f'# HELP {prefixo}_segundos {descricao}: tempo de parede', f'# TYPE {prefixo}_segundos summary']
+        for etiqueta, (_, campos) in zip(etiquetas, itens):
+            linhas.append(f'{prefixo}_segundos_count{etiqueta} {campos.get("contagem", 0)}')
+            linhas.append(f'{prefixo}_segundos_sum{etiqueta} {campos.get("microssegundos", 0) * 1e-6}')
+        for sufixo, tipo_prometheus, ajuda, campo, escala, tipos in SERIES:
+            if tipo not in tipos:
+                continue
+            linhas += [f'# HELP {prefixo}_{sufixo} {descricao}: {ajuda}', f'# TYPE {prefixo}_{sufixo} {tipo_prometheus}']
+            linhas += [f'{prefixo}_{sufixo}{etiqueta} {campos.get(campo, 0) * escala}'
+                       for etiqueta, (_, campos) in zip(etiquetas, itens)]
+    linhas += ['# HELP nicopel_processo_memoria_maxima_bytes Pico de memória residente do processo do servidor',
+               '# TYPE nicopel_processo_memoria_maxima_bytes gauge',
+               f'nicopel_processo_memoria_maxima_bytes {memoria_maxima_processo()}']
+    return '\n'.join(linhas) + '\n'
+
+
+def instrumentar(app):
+    """Mede cada chamada de callback do `app` e publica a rota `/metrics`."""
+    if not METRICAS_ATIVAS:
+        return
+    server = app.server
+
+    @server.before_request
+    def _inicio_callback():
+        if request.path.endswith(ROTA_CALLBACKS):
+            g.inicio_callback = _iniciar_medicao()
+
+    @server.after_request
+    def _fim_callback(response):
+        inicio = g.pop('inicio_callback', None)
+        if inicio is None:
+            return response
+        segundos, pico = _encerrar_medicao(inicio)
+        nome = _nome_callback(app, request.get_json(silent=True))
+        bytes_saida = response.content_length
+        if bytes_saida is None and not response.is_streamed:
+            bytes_saida = len(response.get_data())
+        try:
+            registro.registrar('callback', nome, segundos, request.content_length or 0, bytes_saida or 0, pico)
+        except Exception:
+            log.exception("Falha ao registrar a métrica do callback %s", nome)
+        if LIMITE_LENTO_MS and segundos * 1000 >= LIMITE_LENTO_MS:
+            log.warning("Callback lento: %s levou %.0f ms (entrada %s bytes, saída %s bytes)",
+                        nome, segundos * 1000, request.content_length or 0, bytes_saida or 0)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        if not METRICAS_PUBLICAS and request.remote_addr not in ('127.0.0.1', '::1'):
+            return Response('Não encontrado', status=404)
+        return Response(formatar_prometheus(registro.valores()), mimetype='text/plain; version=0.0.4')
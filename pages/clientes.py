@@ -4,10 +4,14 @@ from dash import dcc, html, callback, Input, Output, State, dash_table
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import pandas as pd
-import io
+import os
+from collections import namedtuple
 
 # Importa a instância 'app' do arquivo app.py
 from index import app
+from armazenamento import caminho_relatorio, gravar_atomico, memoizar_analise, obter_dataset
+from exportacao import FORMATOS, OPCOES_FORMATO
+from metricas import etapa
 
 # Componente de Instruções
 instrucoes_layout = dbc.Alert([
@@ -23,6 +27,115 @@ instrucoes_layout = dbc.Alert([
     ])
 ], color="info")
 
+# --- CAMADA DE ANÁLISE ---
+AnaliseClientes = namedtuple('AnaliseClientes', ['df_filtrado', 'df_recencia', 'df_maior_50k', 'df_menor_50k',
+                                                 'total_geral', 'top_clientes'])
+
+@memoizar_analise
+def analisa_clientes(dataset_id, clientes, vendedores):
+    dataset = obter_dataset(dataset_id, 'clientes')
+    if dataset is None:
+        return None
+    with etapa('clientes.analise'):
+        df_filtrado = dataset.filtrar({'Nome Fantasia': clientes, 'Vendedor da Ultima Compra': vendedores})
+        return AnaliseClientes(
+            df_filtrado=df_filtrado,
+            df_recencia=df_filtrado.sort_values('Dias Sem Comprar', ascending=False),
+            df_maior_50k=df_filtrado[df_filtrado['Faturamento Total'] >= 50000].sort_values('Faturamento Total', ascending=False),
+            df_menor_50k=df_filtrado[df_filtrado['Faturamento Total'] < 50000].sort_values('Faturamento Total', ascending=False),
+            total_geral=df_filtrado['Faturamento Total'].sum(),
+            top_clientes=df_filtrado.nlargest(10, 'Faturamento Total'),
+        )
+
+# --- TABELAS PAGINADAS NO SERVIDOR ---
+# As tabelas de clientes usam page/sort/filter_action='custom': a cada interação o navegador
+# recebe apenas a página visível, recortada de um DataFrame já ordenado e filtrado no servidor.
+TAMANHO_PAGINA = 15
+COLUNAS_TABELA = [
+    {'name': 'Nome Fantasia', 'id': 'Nome Fantasia', 'type': 'text'},
+    {'name': 'Faturamento Total', 'id': 'Faturamento Total', 'type': 'numeric'},
+    {'name': 'Ultima Compra', 'id': 'Ultima Compra', 'type': 'datetime'},
+    {'name': 'Vendedor da Ultima Compra', 'id': 'Vendedor da Ultima Compra', 'type': 'text'},
+    {'name': 'Dias Sem Comprar', 'id': 'Dias Sem Comprar', 'type': 'numeric'},
+]
+OPERADORES_FILTRO = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                     ['contains '], ['datestartswith ']]
+
+def _separar_filtro(parte):
+    """Converte um trecho do filter_query do DataTable (`{coluna} operador valor`) em (coluna, operador, valor).
+
+    O operador é procurado logo após o `}` que fecha o nome da coluna; o valor volta como texto, sem aspas.
+    """
+    parte = parte.strip()
+    fim_nome = parte.find('}')
+    if not parte.startswith('{') or fim_nome < 0:
+        return None, None, None
+    nome, resto = parte[1:fim_nome], parte[fim_nome + 1:].lstrip()
+    for grupo in OPERADORES_FILTRO:
+        for operador in grupo:
+            if not resto.startswith(operador):
+                continue
+            valor = resto[len(operador):].strip()
+            if len(valor) > 1 and valor[0] == valor[-1] and valor[0] in ('"', "'", '`'):
+                valor = valor[1:-1].replace('\\' + valor[0], valor[0])
+            return nome, grupo[0].strip(), valor
+    return None, None, None
+
+def _aplicar_filtro(df, filter_query):
+    """Aplica o filter_query à tabela; trechos com valor inválido para o tipo da coluna são ignorados."""
+    for parte in filter_query.split(' && '):
+        coluna, operador, valor = _separar_filtro(parte)
+        if coluna not in df.columns:
+            continue
+        serie = df[coluna]
+        if operador in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if pd.api.types.is_datetime64_any_dtype(serie):
+                valor = pd.to_datetime(valor, errors='coerce')
+            elif pd.api.types.is_numeric_dtype(serie):
+                valor = pd.to_numeric(valor, errors='coerce')
+            elif isinstance(serie.dtype, pd.CategoricalDtype):
+                serie = serie.astype(str)
+            if pd.isna(valor):
+                continue
+            df = df[getattr(serie, operador)(valor)]
+        elif operador == 'contains':
+            df = df[serie.astype(str).str.contains(valor, case=False, regex=False, na=False)]
+        elif operador == 'datestartswith':
+            df = df[serie.astype(str).str.startswith(valor, na=False)]
+    return df
+
+@memoizar_analise
+def tabela_clientes(dataset_id, clientes, vendedores, faixa, ordenacao, filter_query):
+    """Faixa ('maior' ou 'menor' que 50k) filtrada e ordenada, pronta para ser paginada."""
+    analise = analisa_clientes(dataset_id, list(clientes), list(vendedores))
+    if analise is None:
+        return None
+    df = analise.df_maior_50k if faixa == 'maior' else analise.df_menor_50k
+    if filter_query:
+        df = _aplicar_filtro(df, filter_query)
+    if ordenacao:
+        df = df.sort_values([col for col, _ in ordenacao], ascending=[direcao == 'asc' for _, direcao in ordenacao],
+                            kind='stable')
+    return df
+
+def _pagina_tabela(faixa, page_current, page_size, sort_by, filter_query, clientes, vendedores, dataset_id):
+    ordenacao = tuple((item['column_id'], item['direction']) for item in (sort_by or []))
+    df = tabela_clientes(dataset_id, clientes, vendedores, faixa, ordenacao, filter_query or '')
+    if df is None:
+        return [], 1
+    page_current, page_size = page_current or 0, page_size or TAMANHO_PAGINA
+    pagina = df.iloc[page_current * page_size:(page_current + 1) * page_size].copy()
+    pagina['Ultima Compra'] = pagina['Ultima Compra'].dt.strftime('%Y-%m-%d')
+    return pagina.to_dict('records'), max(1, -(-len(df) // page_size))
+
+def _tabela_paginada(id_tabela):
+    return dash_table.DataTable(
+        id=id_tabela, columns=COLUNAS_TABELA, data=[],
+        page_current=0, page_size=TAMANHO_PAGINA, page_action='custom',
+        sort_action='custom', sort_mode='single', sort_by=[],
+        filter_action='custom', filter_query='', style_table={'overflowX': 'auto'}
+    )
+
 # Layout do dashboard de clientes
 layout = dbc.Row([
     dbc.Col([
@@ -32,122 +145,162 @@ layout = dbc.Row([
         html.Label("Vendedores da Última Compra:", className="mt-3"),
         dcc.Dropdown(id='dropdown-vendedores', multi=True, placeholder="Todos..."),
         html.Hr(),
+        dbc.RadioItems(id='formato-download-clientes', options=OPCOES_FORMATO, value='xlsx', inline=True, className="mb-2"),
         dbc.Button("Baixar Relatório de Clientes", id="btn-download-clientes", color="primary", className="w-100 mb-2"),
+        html.Div(id='painel-progresso-clientes', style={'display': 'none'}, className="mb-2", children=[
+            dbc.Progress(id='progresso-download-clientes', value=0, striped=True, animated=True, className="mb-2"),
+            dbc.Button("Cancelar", id='btn-cancelar-download-clientes', color="secondary", size="sm"),
+        ]),
         dbc.Button("Voltar ao Menu Principal", href="/", color="secondary", className="w-100"),
         dcc.Download(id="download-excel-clientes")
     ], width=12, lg=3, style={'backgroundColor': '#f8f9fa', 'padding': '20px', 'borderRadius': '5px'}),
     
-    dbc.Col(dcc.Loading(html.Div(id='content-clientes')), width=12, lg=9)
+    dbc.Col([
+        # Só a aba ativa é montada; o conteúdo é gerado pelo callback abaixo
+        dcc.Tabs(id='tabs-clientes', value='visao-geral', children=[
+            dcc.Tab(label='Visão Geral', value='visao-geral'),
+            dcc.Tab(label='Clientes >= 50k', value='maior-50k'),
+            dcc.Tab(label='Clientes < 50k', value='menor-50k'),
+        ]),
+        dcc.Loading(html.Div(id='content-clientes'))
+    ], width=12, lg=9)
 ])
 
-# Callback para popular os filtros
+# Callbacks dos filtros: busca no servidor, enviando só as N primeiras opções que casam com o texto digitado
 @app.callback(
-    [Output('dropdown-clientes', 'options'),
-     Output('dropdown-vendedores', 'options')],
-    Input('store-dados-clientes', 'data')
+    Output('dropdown-clientes', 'options'),
+    Input('dropdown-clientes', 'search_value'),
+    [State('dropdown-clientes', 'value'),
+     State('store-dados-clientes', 'data')]
 )
-def popula_filtros_clientes(json_data):
-    if not json_data:
-        return [], []
-    df_analise = pd.read_json(json_data, orient='split')
-    clientes_opcoes = [{'label': i, 'value': i} for i in sorted(df_analise['Nome Fantasia'].unique())]
-    vendedores_opcoes = [{'label': i, 'value': i} for i in sorted(df_analise['Vendedor da Ultima Compra'].unique())]
-    return clientes_opcoes, vendedores_opcoes
+def busca_opcoes_clientes(search_value, selecionados, dataset_id):
+    dataset = obter_dataset(dataset_id, 'clientes')
+    if dataset is None:
+        return []
+    return dataset.opcoes('Nome Fantasia', search_value, selecionados)
+
+@app.callback(
+    Output('dropdown-vendedores', 'options'),
+    Input('dropdown-vendedores', 'search_value'),
+    [State('dropdown-vendedores', 'value'),
+     State('store-dados-clientes', 'data')]
+)
+def busca_opcoes_vendedores(search_value, selecionados, dataset_id):
+    dataset = obter_dataset(dataset_id, 'clientes')
+    if dataset is None:
+        return []
+    return dataset.opcoes('Vendedor da Ultima Compra', search_value, selecionados)
+
+# Conteúdo de cada aba, memorizado por (dataset, seleção, aba) enquanto o usuário alterna entre elas
+@memoizar_analise
+def conteudo_aba_clientes(dataset_id, clientes, vendedores, aba):
+    if aba == 'maior-50k':
+        return html.Div(className="p-4", children=[
+            html.H4("Clientes com Faturamento Acima de R$ 50.000"),
+            _tabela_paginada('tabela-clientes-maior-50k')
+        ])
+    if aba == 'menor-50k':
+        return html.Div(className="p-4", children=[
+            html.H4("Clientes com Faturamento Abaixo de R$ 50.000"),
+            _tabela_paginada('tabela-clientes-menor-50k')
+        ])
+
+    analise = analisa_clientes(dataset_id, list(clientes), list(vendedores))
+    with etapa('clientes.graficos'):
+        fig_rank = px.bar(analise.top_clientes, x='Faturamento Total', y='Nome Fantasia', orientation='h', title='Top 10 Clientes por Faturamento', template='plotly_white').update_yaxes(categoryorder="total ascending")
+    return html.Div(className="p-4", children=[
+        dbc.Row([
+            dbc.Col(dbc.Card([dbc.CardBody([html.H4("Faturamento Total (Filtrado)"), html.P(f"R$ {analise.total_geral:,.2f}")])])),
+            dbc.Col(dbc.Card(dbc.CardBody([html.H4("Clientes na Análise"), html.P(analise.df_filtrado['Nome Fantasia'].nunique())]))),
+        ], className="mb-4 g-4"),
+        dcc.Graph(figure=fig_rank)
+    ])
 
 # Callback para atualizar o conteúdo da página de clientes
 @app.callback(
     Output('content-clientes', 'children'),
     [Input('dropdown-clientes', 'value'),
-     Input('dropdown-vendedores', 'value')],
+     Input('dropdown-vendedores', 'value'),
+     Input('tabs-clientes', 'value')],
     State('store-dados-clientes', 'data')
 )
-def atualiza_dash_clientes(clientes, vendedores, json_data):
-    if not json_data:
+def atualiza_dash_clientes(clientes, vendedores, aba, dataset_id):
+    analise = analisa_clientes(dataset_id, clientes, vendedores)
+    if analise is None:
         return dbc.Alert("Dados não encontrados. Volte à página inicial e carregue o arquivo.", color="danger")
 
-    df_analise = pd.read_json(json_data, orient='split')
-    df_analise['Ultima Compra'] = pd.to_datetime(df_analise['Ultima Compra'])
-    
-    df_filtrado = df_analise.copy()
-    if clientes:
-        df_filtrado = df_filtrado[df_filtrado['Nome Fantasia'].isin(clientes)]
-    if vendedores:
-        df_filtrado = df_filtrado[df_filtrado['Vendedor da Ultima Compra'].isin(vendedores)]
-
-    if df_filtrado.empty:
+    if analise.df_filtrado.empty:
         return dbc.Alert("Nenhum dado encontrado para os filtros selecionados.", color="warning", className="mt-4")
-        
-    # Prepara os dataframes para as abas
-    df_recencia_filtrado = df_filtrado.sort_values('Dias Sem Comprar', ascending=False)
-    df_clientes_maior_50k = df_filtrado[df_filtrado['Faturamento Total'] >= 50000].sort_values('Faturamento Total', ascending=False)
-    df_clientes_menor_50k = df_filtrado[df_filtrado['Faturamento Total'] < 50000].sort_values('Faturamento Total', ascending=False)
-    
-    # Prepara os dados para o gráfico da Visão Geral
-    total_geral = df_filtrado['Faturamento Total'].sum()
-    top_clientes = df_filtrado.nlargest(10, 'Faturamento Total')
-    fig_rank = px.bar(top_clientes, x='Faturamento Total', y='Nome Fantasia', orientation='h', title='Top 10 Clientes por Faturamento', template='plotly_white').update_yaxes(categoryorder="total ascending")
-
-    # Retorna o layout com abas
-    return dcc.Tabs([
-        dcc.Tab(label='Visão Geral', children=html.Div(className="p-4", children=[
-            dbc.Row([
-                dbc.Col(dbc.Card([dbc.CardBody([html.H4("Faturamento Total (Filtrado)"), html.P(f"R$ {total_geral:,.2f}")])])),
-                dbc.Col(dbc.Card(dbc.CardBody([html.H4("Clientes na Análise"), html.P(df_filtrado['Nome Fantasia'].nunique())]))),
-            ], className="mb-4 g-4"),
-            dcc.Graph(figure=fig_rank)
-        ])),
-        dcc.Tab(label='Clientes >= 50k', children=html.Div(className="p-4", children=[
-            html.H4("Clientes com Faturamento Acima de R$ 50.000"),
-            dash_table.DataTable(
-                data=df_clientes_maior_50k.to_dict('records'),
-                columns=[{'name': i, 'id': i} for i in df_clientes_maior_50k.columns],
-                page_size=15, sort_action='native', filter_action='native', style_table={'overflowX': 'auto'}
-            )
-        ])),
-        dcc.Tab(label='Clientes < 50k', children=html.Div(className="p-4", children=[
-            html.H4("Clientes com Faturamento Abaixo de R$ 50.000"),
-            dash_table.DataTable(
-                data=df_clientes_menor_50k.to_dict('records'),
-                columns=[{'name': i, 'id': i} for i in df_clientes_menor_50k.columns],
-                page_size=15, sort_action='native', filter_action='native', style_table={'overflowX': 'auto'}
-            )
-        ]))
-    ])
+
+    return conteudo_aba_clientes(dataset_id, clientes, vendedores, aba)
+
+# Callbacks de paginação, ordenação e filtro das tabelas (executados no servidor)
+@app.callback(
+    [Output('tabela-clientes-maior-50k', 'data'),
+     Output('tabela-clientes-maior-50k', 'page_count')],
+    [Input('tabela-clientes-maior-50k', 'page_current'),
+     Input('tabela-clientes-maior-50k', 'page_size'),
+     Input('tabela-clientes-maior-50k', 'sort_by'),
+     Input('tabela-clientes-maior-50k', 'filter_query')],
+    [State('dropdown-clientes', 'value'),
+     State('dropdown-vendedores', 'value'),
+     State('store-dados-clientes', 'data')]
+)
+def pagina_clientes_maior_50k(page_current, page_size, sort_by, filter_query, clientes, vendedores, dataset_id):
+    return _pagina_tabela('maior', page_current, page_size, sort_by, filter_query, clientes, vendedores, dataset_id)
+
+@app.callback(
+    [Output('tabela-clientes-menor-50k', 'data'),
+     Output('tabela-clientes-menor-50k', 'page_count')],
+    [Input('tabela-clientes-menor-50k', 'page_current'),
+     Input('tabela-clientes-menor-50k', 'page_size'),
+     Input('tabela-clientes-menor-50k', 'sort_by'),
+     Input('tabela-clientes-menor-50k', 'filter_query')],
+    [State('dropdown-clientes', 'value'),
+     State('dropdown-vendedores', 'value'),
+     State('store-dados-clientes', 'data')]
+)
+def pagina_clientes_menor_50k(page_current, page_size, sort_by, filter_query, clientes, vendedores, dataset_id):
+    return _pagina_tabela('menor', page_current, page_size, sort_by, filter_query, clientes, vendedores, dataset_id)
 
 # NOVO CALLBACK PARA O DOWNLOAD DO EXCEL DE CLIENTES
+# Roda em segundo plano; o arquivo fica guardado por (dataset, filtros) e um novo clique é servido do disco
 @app.callback(
     Output("download-excel-clientes", "data"),
     Input("btn-download-clientes", "n_clicks"),
     [State('store-dados-clientes', 'data'),
+     State('formato-download-clientes', 'value'),
      State('dropdown-clientes', 'value'),
      State('dropdown-vendedores', 'value')],
     prevent_initial_call=True,
+    background=True,
+    progress=[Output('progresso-download-clientes', 'value'), Output('progresso-download-clientes', 'label')],
+    running=[(Output('btn-download-clientes', 'disabled'), True, False),
+             (Output('painel-progresso-clientes', 'style'), {'display': 'block'}, {'display': 'none'})],
+    cancel=[Input('btn-cancelar-download-clientes', 'n_clicks')],
 )
-def gera_excel_clientes(n_clicks, json_data, clientes, vendedores):
-    if not n_clicks or not json_data:
+def gera_excel_clientes(set_progress, n_clicks, dataset_id, formato, clientes, vendedores):
+    if not n_clicks or not dataset_id:
         raise dash.exceptions.PreventUpdate
 
-    df_analise = pd.read_json(json_data, orient='split')
-    df_analise['Ultima Compra'] = pd.to_datetime(df_analise['Ultima Compra'])
-    
-    df_filtrado = df_analise.copy()
-    if clientes:
-        df_filtrado = df_filtrado[df_filtrado['Nome Fantasia'].isin(clientes)]
-    if vendedores:
-        df_filtrado = df_filtrado[df_filtrado['Vendedor da Ultima Compra'].isin(vendedores)]
+    extensao, escrever = FORMATOS.get(formato, FORMATOS['xlsx'])
+    nome_arquivo = "Relatorio_Analise_Clientes" + extensao
+    caminho = caminho_relatorio(dataset_id, 'clientes', clientes, vendedores) + extensao
+    if os.path.exists(caminho):
+        return dcc.send_file(caminho, filename=nome_arquivo)
 
-    if df_filtrado.empty:
+    # Reaproveita a análise já calculada para o dashboard com os mesmos filtros
+    set_progress((10, "Filtrando..."))
+    analise = analisa_clientes(dataset_id, clientes, vendedores)
+    if analise is None or analise.df_filtrado.empty:
         raise dash.exceptions.PreventUpdate
 
-    # Prepara os relatórios para o Excel
-    df_recencia_filtrado = df_filtrado.sort_values('Dias Sem Comprar', ascending=False)
-    df_clientes_maior_50k = df_filtrado[df_filtrado['Faturamento Total'] >= 50000].sort_values('Faturamento Total', ascending=False)
-    df_clientes_menor_50k = df_filtrado[df_filtrado['Faturamento Total'] < 50000].sort_values('Faturamento Total', ascending=False)
-    
-    output_buffer = io.BytesIO()
-    with pd.ExcelWriter(output_buffer, engine='xlsxwriter') as writer:
-        df_recencia_filtrado.to_excel(writer, sheet_name='Relatorio_Geral_Filtrado', index=False)
-        df_clientes_maior_50k.to_excel(writer, sheet_name='Clientes_Acima_50k', index=False)
-        df_clientes_menor_50k.to_excel(writer, sheet_name='Clientes_Abaixo_50k', index=False)
+    planilhas = [('Relatorio_Geral_Filtrado', analise.df_recencia),
+                 ('Clientes_Acima_50k', analise.df_maior_50k),
+                 ('Clientes_Abaixo_50k', analise.df_menor_50k)]
 
-    return dcc.send_bytes(output_buffer.getvalue(), "Relatorio_Analise_Clientes.xlsx")
\ No newline at end of file
+    # Gravado direto no arquivo, em lotes; o download é servido do disco
+    progresso = lambda fracao, texto: set_progress((20 + round(80 * fracao), texto))
+    with etapa(f'clientes.exportacao_{formato}'):
+        gravar_atomico(caminho, lambda destino: escrever(destino, planilhas, progresso))
+    return dcc.send_file(caminho, filename=nome_arquivo)
@@ -4,13 +4,125 @@ from dash import dcc, html, callback, Input, Output, State
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import pandas as pd
-import io
+import numpy as np
+import os
+import re
+from collections import namedtuple
 
 # Importa a instância 'app' do arquivo app.py
 from index import app
+from armazenamento import caminho_relatorio, carregar_original, gravar_atomico, memoizar_analise, obter_dataset
+from exportacao import FORMATOS, OPCOES_FORMATO
+from graficos import grafico_linhas
+from metricas import etapa
 
 # Constantes específicas deste dashboard
-CATEGORIAS_EXCLUIR = ['CAIXA SORVETE/AÇAI', 'CAIXA DE PIZZA']
+# Categorias cujo nome contém um destes trechos (sem diferenciar maiúsculas) ficam fora da análise.
+# O padrão vem de NICOPEL_CATEGORIAS_EXCLUIR e pode ser alterado na própria página.
+CATEGORIAS_EXCLUIR = os.environ.get('NICOPEL_CATEGORIAS_EXCLUIR', 'CAIXA SORVETE/AÇAI, CAIXA DE PIZZA')
+
+
+def lista_exclusao(texto):
+    """Trechos da lista de exclusão (separados por vírgula) como tupla ordenada, usada na chave do memo."""
+    return tuple(sorted({trecho.strip() for trecho in (texto or '').split(',') if trecho.strip()}))
+
+
+def _regex_exclusao(excluir):
+    return '|'.join(re.escape(trecho) for trecho in excluir)
+
+
+@memoizar_analise
+def _categorias_excluidas(dataset_id, nome, excluir):
+    """Tabela por código de categoria: True para as categorias excluídas.
+
+    Avalia o texto uma vez por categoria distinta, e só de novo quando a lista de exclusão muda.
+    """
+    dataset = obter_dataset(dataset_id, nome)
+    categorias = dataset.df['Categoria'].cat.categories
+    if excluir:
+        excluidas = np.asarray(categorias.astype(str).str.contains(_regex_exclusao(excluir), case=False, regex=True),
+                               dtype=bool)
+    else:
+        excluidas = np.zeros(len(categorias), dtype=bool)
+    # A última posição atende o código -1 (categoria vazia), que nunca é excluída
+    return np.append(excluidas, False)
+
+
+def _excluir_categorias(df, excluidas):
+    return df[~excluidas[df['Categoria'].cat.codes.to_numpy()]]
+
+
+def _resumos_franquias(cubo):
+    """Visões do dashboard como somas sobre o cubo semanal já filtrado."""
+    total_por_franquia = cubo.groupby('FRANQUIA', observed=True)['R$ Total'].sum().sort_values(ascending=False).reset_index()
+    # Série semanal por franquia, com as semanas sem venda zeradas (como o `resample('W-MON')`)
+    semanal = cubo.groupby(['FRANQUIA', 'Semana'], observed=True)['R$ Total'].sum()
+    partes = []
+    for franquia, serie in semanal.groupby(level='FRANQUIA', observed=True):
+        serie = serie.droplevel('FRANQUIA')
+        semanas = pd.date_range(serie.index.min(), serie.index.max(), freq='W-MON')
+        partes.append(pd.DataFrame({'FRANQUIA': franquia, 'Data Emissao': semanas, 'R$ Total': serie.reindex(semanas, fill_value=0).to_numpy()}))
+    faturamento_semanal = pd.concat(partes, ignore_index=True)
+    top_categorias = cubo.groupby('Categoria', observed=True)['R$ Total'].sum().nlargest(4).reset_index()
+    top_vendedores = cubo.groupby('Vendedor', observed=True)['R$ Total'].sum().nlargest(10).reset_index()
+    return total_por_franquia, faturamento_semanal, top_categorias, top_vendedores
+
+
+# --- CAMADA DE ANÁLISE ---
+AnaliseFranquias = namedtuple('AnaliseFranquias', ['total_geral', 'total_por_franquia', 'faturamento_semanal',
+                                                   'top_categorias', 'top_vendedores'])
+
+@memoizar_analise
+def analisa_franquias(dataset_id, franquias, itens, excluir=()):
+    cubo = obter_dataset(dataset_id, 'cubo_franquias')
+    if cubo is None:
+        return None
+    with etapa('franquias.analise'):
+        cubo_filtrado = _excluir_categorias(cubo.filtrar({'FRANQUIA': franquias, 'Descrição Item': itens}),
+                                            _categorias_excluidas(dataset_id, 'cubo_franquias', excluir))
+        if cubo_filtrado.empty:
+            return AnaliseFranquias(0.0, None, None, None, None)
+        return AnaliseFranquias(cubo_filtrado['R$ Total'].sum(), *_resumos_franquias(cubo_filtrado))
+
+
+@memoizar_analise
+def linhas_franquias(dataset_id, franquias, itens, excluir=()):
+    dataset = obter_dataset(dataset_id, 'franquias')
+    if dataset is None:
+        return None
+    with etapa('franquias.linhas'):
+        return _excluir_categorias(dataset.filtrar({'FRANQUIA': franquias, 'Descrição Item': itens}),
+                                   _categorias_excluidas(dataset_id, 'franquias', excluir))
+
+
+def linhas_originais_franquias(dataset_id, franquias, itens, excluir=()):
+    """Linhas do arquivo original (todas as colunas, como vieram) com os filtros do dashboard.
+
+    Lidas do Parquet do upload só na exportação; o filtro de franquias/itens é aplicado na leitura.
+    """
+    filtros = [('FRANQUIA', 'in', list(franquias))]
+    if itens:
+        filtros.append(('Descrição Item', 'in', list(itens)))
+    with etapa('franquias.linhas_originais'):
+        df = carregar_original(dataset_id, filtros=filtros)
+        # O arquivo original guarda o cabeçalho como veio (ex.: ' Categoria ')
+        categoria = next((col for col in (df.columns if df is not None else []) if str(col).strip() == 'Categoria'), None)
+        if categoria is None or not excluir:
+            return df
+        return df[~df[categoria].astype('string').str.contains(_regex_exclusao(excluir), case=False, na=False)]
+
+# Figuras memorizadas por (dataset, seleção): voltar a uma seleção já vista não remonta os gráficos.
+# A linha semanal tem o número de pontos limitado (LTTB/WebGL, ver graficos.py) para qualquer
+# quantidade de franquias selecionadas.
+@memoizar_analise
+def figuras_franquias(dataset_id, franquias, itens, excluir=()):
+    analise = analisa_franquias(dataset_id, franquias, itens, excluir)
+    with etapa('franquias.graficos'):
+        fig_rank = px.bar(analise.total_por_franquia, x='R$ Total', y='FRANQUIA', orientation='h', title='Ranking de Faturamento Total', template='plotly_white').update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
+        fig_semanal = grafico_linhas(analise.faturamento_semanal, 'Data Emissao', 'R$ Total', 'FRANQUIA', 'Desempenho Semanal')
+        fig_categorias = px.pie(analise.top_categorias, values='R$ Total', names='Categoria', title='Top 4 Categorias', hole=.3, template='plotly_white').update_layout(title_x=0.5)
+        fig_vendedores = px.bar(analise.top_vendedores, x='R$ Total', y='Vendedor', orientation='h', title='Top 10 Vendedores', template='plotly_white').update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
+    return fig_rank, fig_semanal, fig_categorias, fig_vendedores
 
 # Layout do dashboard de franquias
 layout = dbc.Row([
@@ -20,72 +132,77 @@ layout = dbc.Row([
         dcc.Dropdown(id='dropdown-franquias-main', multi=True, placeholder="Selecione..."),
         html.Label("Itens (Opcional):", className="mt-3"),
         dcc.Dropdown(id='dropdown-itens-main', multi=True, placeholder="Selecione..."),
+        html.Label("Excluir categorias que contenham (separadas por vírgula):", className="mt-3"),
+        dbc.Input(id='input-categorias-excluir', value=CATEGORIAS_EXCLUIR, debounce=True),
         html.Hr(),
         dbc.Button("Voltar ao Menu Principal", href="/", color="secondary", className="w-100 mb-2"),
         # Adiciona o botão de download e o componente de download
-        dbc.Button("Baixar Relatório em Excel", id="btn-download-franquias", color="primary", className="w-100"),
+        dbc.RadioItems(id='formato-download-franquias', options=OPCOES_FORMATO, value='xlsx', inline=True, className="mb-2"),
+        dbc.Checkbox(id='incluir-originais-franquias', label="Incluir as linhas originais (todas as colunas)",
+                     value=False, className="mb-2"),
+        dbc.Button("Baixar Relatório", id="btn-download-franquias", color="primary", className="w-100"),
+        html.Div(id='painel-progresso-franquias', style={'display': 'none'}, className="mt-2", children=[
+            dbc.Progress(id='progresso-download-franquias', value=0, striped=True, animated=True, className="mb-2"),
+            dbc.Button("Cancelar", id='btn-cancelar-download-franquias', color="secondary", size="sm"),
+        ]),
         dcc.Download(id="download-excel-franquias")
     ], width=12, lg=3, style={'backgroundColor': '#f8f9fa', 'padding': '20px', 'borderRadius': '5px'}),
     
     dbc.Col(dcc.Loading(html.Div(id='dashboard-franquias-content')), width=12, lg=9)
 ])
 
-# Callback para popular os filtros
+# Callbacks dos filtros: busca no servidor, enviando só as N primeiras opções que casam com o texto digitado
 @app.callback(
-    [Output('dropdown-franquias-main', 'options'),
-     Output('dropdown-itens-main', 'options')],
-    Input('store-dados-franquias', 'data')
+    Output('dropdown-franquias-main', 'options'),
+    Input('dropdown-franquias-main', 'search_value'),
+    [State('dropdown-franquias-main', 'value'),
+     State('store-dados-franquias', 'data')]
 )
-def popula_filtros_franquias(json_data):
-    if not json_data:
-        return [], []
-    df_franquias = pd.read_json(json_data, orient='split')
-    # CORREÇÃO: Transforma a lista de strings em uma lista de dicionários para o Dropdown
-    franquias_opcoes = [{'label': i, 'value': i} for i in sorted(df_franquias['FRANQUIA'].unique())]
-    itens_opcoes = [{'label': i, 'value': i} for i in sorted(df_franquias['Descrição Item'].unique())]
-    return franquias_opcoes, itens_opcoes
+def busca_opcoes_franquias(search_value, selecionados, dataset_id):
+    dataset = obter_dataset(dataset_id, 'franquias')
+    if dataset is None:
+        return []
+    return dataset.opcoes('FRANQUIA', search_value, selecionados)
+
+@app.callback(
+    Output('dropdown-itens-main', 'options'),
+    Input('dropdown-itens-main', 'search_value'),
+    [State('dropdown-itens-main', 'value'),
+     State('store-dados-franquias', 'data')]
+)
+def busca_opcoes_itens(search_value, selecionados, dataset_id):
+    dataset = obter_dataset(dataset_id, 'franquias')
+    if dataset is None:
+        return []
+    return dataset.opcoes('Descrição Item', search_value, selecionados)
 
 # Callback para atualizar o conteúdo da página de franquias
 @app.callback(
     Output('dashboard-franquias-content', 'children'),
     [Input('dropdown-franquias-main', 'value'),
-     Input('dropdown-itens-main', 'value')],
+     Input('dropdown-itens-main', 'value'),
+     Input('input-categorias-excluir', 'value')],
     State('store-dados-franquias', 'data')
 )
-def atualiza_dash_franquias(franquias, itens, json_data):
-    if not json_data or not franquias:
+def atualiza_dash_franquias(franquias, itens, categorias_excluir, dataset_id):
+    if not dataset_id or not franquias:
         return dbc.Alert("Selecione uma ou mais franquias para começar a análise.", color="info", className="mt-4")
     
-    df_franquias = pd.read_json(json_data, orient='split')
-    df_franquias['Data Emissao'] = pd.to_datetime(df_franquias['Data Emissao'])
-    
-    # Aplica filtros
-    df_filtrado = df_franquias[df_franquias['FRANQUIA'].isin(franquias)]
-    if itens:
-        df_filtrado = df_filtrado[df_filtrado['Descrição Item'].isin(itens)]
-        
-    regex = '|'.join(CATEGORIAS_EXCLUIR)
-    df_filtrado = df_filtrado[~df_filtrado['Categoria'].str.contains(regex, case=False, na=False)]
+    excluir = lista_exclusao(categorias_excluir)
+    analise = analisa_franquias(dataset_id, franquias, itens, excluir)
+    if analise is None:
+        return dbc.Alert("Dados não encontrados. Volte à página inicial e carregue o arquivo.", color="danger")
 
-    if df_filtrado.empty:
+    if analise.total_por_franquia is None:
         return dbc.Alert("Nenhum dado encontrado para os filtros selecionados.", color="warning", className="mt-4")
 
-    # --- CÁLCULOS PARA OS GRÁFICOS ---
-    total_por_franquia = df_filtrado.groupby('FRANQUIA')['R$ Total'].sum().sort_values(ascending=False).reset_index()
-    faturamento_semanal = df_filtrado.set_index('Data Emissao').groupby('FRANQUIA').resample('W-MON').agg({'R$ Total': 'sum'}).reset_index()
-    top_categorias = df_filtrado.groupby('Categoria')['R$ Total'].sum().nlargest(4).reset_index()
-    top_vendedores = df_filtrado.groupby('Vendedor')['R$ Total'].sum().nlargest(10).reset_index()
-
     # --- CRIAÇÃO DOS GRÁFICOS ---
-    fig_rank = px.bar(total_por_franquia, x='R$ Total', y='FRANQUIA', orientation='h', title='Ranking de Faturamento Total', template='plotly_white').update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
-    fig_semanal = px.line(faturamento_semanal, x='Data Emissao', y='R$ Total', color='FRANQUIA', title='Desempenho Semanal', template='plotly_white', markers=True).update_layout(title_x=0.5)
-    fig_categorias = px.pie(top_categorias, values='R$ Total', names='Categoria', title='Top 4 Categorias', hole=.3, template='plotly_white').update_layout(title_x=0.5)
-    fig_vendedores = px.bar(top_vendedores, x='R$ Total', y='Vendedor', orientation='h', title='Top 10 Vendedores', template='plotly_white').update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
+    fig_rank, fig_semanal, fig_categorias, fig_vendedores = figuras_franquias(dataset_id, franquias, itens, excluir)
     
     # --- MONTAGEM DO LAYOUT DO DASHBOARD ---
     return html.Div([
         dbc.Row([
-            dbc.Col(dbc.Card(dbc.CardBody([html.H5("Faturamento Total (Filtrado)"), html.H4(f"R$ {df_filtrado['R$ Total'].sum():,.2f}")]))),
+            dbc.Col(dbc.Card(dbc.CardBody([html.H5("Faturamento Total (Filtrado)"), html.H4(f"R$ {analise.total_geral:,.2f}")]))),
             dbc.Col(dbc.Card(dbc.CardBody([html.H5("Franquias na Análise"), html.H4(len(franquias))]))),
         ], className="mb-4 g-4"),
         dbc.Row([
@@ -99,43 +216,55 @@ def atualiza_dash_franquias(franquias, itens, json_data):
     ])
 
 # --- NOVO CALLBACK PARA DOWNLOAD ---
+# Roda em segundo plano; o arquivo fica guardado por (dataset, filtros) e um novo clique é servido do disco
 @app.callback(
     Output("download-excel-franquias", "data"),
     Input("btn-download-franquias", "n_clicks"),
     [State('store-dados-franquias', 'data'),
+     State('formato-download-franquias', 'value'),
      State('dropdown-franquias-main', 'value'),
-     State('dropdown-itens-main', 'value')],
+     State('dropdown-itens-main', 'value'),
+     State('input-categorias-excluir', 'value'),
+     State('incluir-originais-franquias', 'value')],
     prevent_initial_call=True,
+    background=True,
+    progress=[Output('progresso-download-franquias', 'value'), Output('progresso-download-franquias', 'label')],
+    running=[(Output('btn-download-franquias', 'disabled'), True, False),
+             (Output('painel-progresso-franquias', 'style'), {'display': 'block'}, {'display': 'none'})],
+    cancel=[Input('btn-cancelar-download-franquias', 'n_clicks')],
 )
-def gera_excel_franquias(n_clicks, json_data, franquias, itens):
-    if not n_clicks or not json_data or not franquias:
+def gera_excel_franquias(set_progress, n_clicks, dataset_id, formato, franquias, itens, categorias_excluir,
+                         incluir_originais=False):
+    if not n_clicks or not dataset_id or not franquias:
         raise dash.exceptions.PreventUpdate
 
-    df_franquias = pd.read_json(json_data, orient='split')
-    df_franquias['Data Emissao'] = pd.to_datetime(df_franquias['Data Emissao'])
-    
-    # Replica a mesma lógica de filtros do dashboard
-    df_filtrado = df_franquias[df_franquias['FRANQUIA'].isin(franquias)]
-    if itens:
-        df_filtrado = df_filtrado[df_filtrado['Descrição Item'].isin(itens)]
-    regex = '|'.join(CATEGORIAS_EXCLUIR)
-    df_final = df_filtrado[~df_filtrado['Categoria'].str.contains(regex, case=False, na=False)]
+    excluir = lista_exclusao(categorias_excluir)
+    extensao, escrever = FORMATOS.get(formato, FORMATOS['xlsx'])
+    nome_arquivo = "Relatorio_Analitico_Franquias" + extensao
+    caminho = caminho_relatorio(dataset_id, 'franquias', franquias, itens, excluir, bool(incluir_originais)) + extensao
+    if os.path.exists(caminho):
+        return dcc.send_file(caminho, filename=nome_arquivo)
 
-    if df_final.empty:
+    # Reaproveita os resumos já calculados para o dashboard com os mesmos filtros
+    set_progress((10, "Filtrando..."))
+    analise = analisa_franquias(dataset_id, franquias, itens, excluir)
+    df_final = linhas_franquias(dataset_id, franquias, itens, excluir)
+    if analise is None or df_final is None or df_final.empty:
         raise dash.exceptions.PreventUpdate
-    
-    # Recalcula os resumos para exportação
-    total_por_franquia = df_final.groupby('FRANQUIA')['R$ Total'].sum().sort_values(ascending=False).reset_index()
-    faturamento_semanal = df_final.set_index('Data Emissao').groupby('FRANQUIA').resample('W-MON').agg({'R$ Total': 'sum'}).reset_index()
-    top_categorias = df_final.groupby('Categoria')['R$ Total'].sum().nlargest(4).reset_index()
-    top_vendedores = df_final.groupby('Vendedor')['R$ Total'].sum().nlargest(10).reset_index()
-
-    output_buffer = io.BytesIO()
-    with pd.ExcelWriter(output_buffer, engine='xlsxwriter') as writer:
-        df_final.to_excel(writer, sheet_name='Dados_Filtrados', index=False)
-        total_por_franquia.to_excel(writer, sheet_name='Resumo_Total_Franquia', index=False)
-        faturamento_semanal.to_excel(writer, sheet_name='Resumo_Semanal', index=False)
-        top_categorias.to_excel(writer, sheet_name='Resumo_Categorias', index=False)
-        top_vendedores.to_excel(writer, sheet_name='Resumo_Vendedores', index=False)
-    
-    return dcc.send_bytes(output_buffer.getvalue(), "Relatorio_Analitico_Franquias.xlsx")
\ No newline at end of file
+
+    planilhas = [('Dados_Filtrados', df_final),
+                 ('Resumo_Total_Franquia', analise.total_por_franquia),
+                 ('Resumo_Semanal', analise.faturamento_semanal),
+                 ('Resumo_Categorias', analise.top_categorias),
+                 ('Resumo_Vendedores', analise.top_vendedores)]
+    if incluir_originais:
+        set_progress((15, "Lendo as linhas originais..."))
+        originais = linhas_originais_franquias(dataset_id, franquias, itens, excluir)
+        if originais is not None:
+            planilhas.append(('Linhas_Originais', originais))
+
+    # Gravado direto no arquivo, em lotes; o download é servido do disco
+    progresso = lambda fracao, texto: set_progress((20 + round(80 * fracao), texto))
+    with etapa(f'franquias.exportacao_{formato}'):
+        gravar_atomico(caminho, lambda destino: escrever(destino, planilhas, progresso))
+    return dcc.send_file(caminho, filename=nome_arquivo)